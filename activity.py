@@ -4,204 +4,505 @@
 # Original author: Miroslav Suchý
 
 from fasjson_client import Client
+from fasjson_client.errors import APIError
 from six.moves import configparser
-from functools import wraps, cached_property
+from functools import wraps
 from datetime import datetime, date, timedelta
 from munch import Munch
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import contextlib
+import threading
 import json
+import zlib
 import time
-import xmlrpc
+import xmlrpc.client
 import bugzilla
+import requests
 import getpass
 import sys
 import os
 import six
-import requests
 
-from groups import fetch_personal_config
+import resilience
+import transport
+import metrics
+from metrics import metrics as stats
+from groups import (
+    fetch_personal_config,
+    fetch_personal_configs,
+    get_sponsors_usernames,
+    get_fas_user,
+    get_fas_users,
+    list_sponsorships,
+)
+from cache import cache, MISSING
+from ledger import Ledger
 
 
 DAYS_AGO = 365 * 2
 
+# Sponsors whose last known activity is going to fall out of the `DAYS_AGO`
+# window within this many days are re-examined even in incremental mode
+EXPIRY_MARGIN = 30
+
+# Mapping of sponsor usernames to lists of `(username, date)` tuples of users
+# they recently sponsored, see `find_directly_sponsored`
 # TODO This should not be global
 DIRECTLY_SPONSORED = {}
 
+# Result of `process_user_safe` when we were unable to find out whether
+# a sponsor is active or not
+UNKNOWN = object()
+
+# How many requests we are allowed to send to each backend at the same time.
+# These are only defaults, see `parse_args`
+BACKEND_CONCURRENCY = {
+    "fas": 4,
+    "bugzilla": 4,
+    "fedorapeople": 8,
+    "datagrepper": 2,
+}
 
-class IDtoNameCache:
+# Created here, before any thread can ask for them, so that every backend has
+# exactly one semaphore
+_backend_limits = dict(BACKEND_CONCURRENCY)
+_backend_semaphores = {
+    name: threading.BoundedSemaphore(limit)
+    for name, limit in _backend_limits.items()
+}
+
+
+def set_backend_concurrency(limits):
+    """
+    Configure the maximum number of parallel requests for each backend. This
+    must be called before any requests are sent.
     """
-    Converting `user_id` to FAS username is an expensive operation, therefore
-    we want to cache the results and once known usernames simply return from
-    memory.
+    for name, limit in limits.items():
+        _backend_limits[name] = limit
+        _backend_semaphores[name] = threading.BoundedSemaphore(limit)
 
-    Maybe we don't need this whole class and can implement an username property
-    in `User` class.
+
+def backend_limit(name):
+    """
+    The configured maximum number of parallel requests for a backend. Bulk
+    downloads that don't go through `backend` use it as their number of
+    workers.
     """
+    return _backend_limits[name]
 
-    # Cache mapping of user id to name
-    map_id_to_name = {}
 
-    @classmethod
-    def convert_id_to_name(cls, user_id, client):
-        if user_id not in cls.map_id_to_name:
-            name = client.person_by_id(user_id).username
-            cls.map_id_to_name[user_id] = name
-        return cls.map_id_to_name[user_id]
+@contextlib.contextmanager
+def backend(name):
+    """
+    Wrap a block of code talking to a remote backend (FAS, Bugzilla,
+    fedorapeople) so that we don't exceed its concurrency limit
+    """
+    with _backend_semaphores[name]:
+        yield
 
 
-def get_bugs(bz, user):
+def review_bugs_query(since=None):
     """
-    Fetch all _recent_ Fedora Review bugs that are assigned to a given FAS user
+    Bugzilla query for all _recent_ Fedora Review bugs. If `since` date is
+    specified, only bugs changed after it.
     """
     query = {
         'query_format': 'advanced',
         'component': 'Package Review',
         'classification': 'Fedora',
         'product': 'Fedora',
+        'list_id': '3718380',
+    }
+    if since:
+        # Any change counts, e.g. a fedora-review+ flag doesn't change the
+        # bug status
+        query['last_change_time'] = since.isoformat()
+    else:
+        query.update({
+            'chfieldto': 'Now',
+            'chfieldfrom': '-{0}d'.format(DAYS_AGO),
+            'chfield': 'bug_status',
+        })
+    return query
+
+
+def query_window(query):
+    """
+    A short description of the time range of a `review_bugs_query`, to be
+    used in cache keys
+    """
+    return query.get('last_change_time') or query['chfieldfrom']
+
+
+def get_bugs(bz, user, since=None, index=None):
+    """
+    Fetch all _recent_ Fedora Review bugs that are assigned to a given FAS user.
+    If `since` date is specified, fetch only bugs changed after it.
+    If a `ReviewBugsIndex` that covers `since` is specified, don't query
+    Bugzilla at all.
+    """
+    if index and index.covers(since):
+        return index.get_bugs(user.email, since)
+
+    query = review_bugs_query(since)
+    query.update({
         'emailtype1': 'substring',
         'email1': user.email,
         'emailassigned_to1': '1',
-        'list_id': '3718380',
-        'chfieldto': 'Now',
-        'chfieldfrom': '-{0}d'.format(DAYS_AGO),
-        'chfield': 'bug_status'
-    }
-    return bz.query(query)
+    })
+
+    def fetch():
+        with backend("bugzilla"):
+            bugs = resilience.call("bugzilla", bz.query, query)
+            return [bug.get_raw_data() for bug in bugs]
+
+    key = "{0}-{1}".format(user.email, query_window(query))
+    raw_bugs = cache.cached("bugzilla-bugs", key, fetch)
+    return [bugzilla.Bug(bz, dict=raw) for raw in raw_bugs]
+
+
+class ReviewBugsIndex:
+    """
+    All recent Fedora Review bugs, fetched in a couple of paginated bulk queries
+    and indexed by their assignee. The number of Bugzilla searches then doesn't
+    depend on the number of sponsors.
+    """
+
+    # Bugzilla refuses to return too many bugs at once
+    page_size = 1000
+
+    fields = ["id", "assigned_to", "blocks", "last_change_time", "status"]
+
+    def __init__(self, bz, since=None):
+        self.bz = bz
+        self.since = since
+        self.by_assignee = {}
+        for raw in self._fetch():
+            bug = bugzilla.Bug(bz, dict=raw)
+            self.by_assignee.setdefault(bug.assigned_to.lower(), []).append(bug)
+
+    def _fetch(self):
+        query = review_bugs_query(self.since)
+        query["include_fields"] = self.fields
+        # Without a stable order, pages could overlap or skip bugs
+        query["order"] = "bug_id"
+
+        def fetch_page(offset):
+            with backend("bugzilla"):
+                bugs = resilience.call(
+                    "bugzilla", self.bz.query,
+                    dict(query, limit=self.page_size, offset=offset))
+                return [bug.get_raw_data() for bug in bugs]
+
+        # Pages are cached all together, so that they are always from the
+        # same point in time
+        def fetch():
+            result = []
+            offset = 0
+            while True:
+                page = fetch_page(offset)
+                result.extend(page)
+                if len(page) < self.page_size:
+                    return result
+                offset += self.page_size
+
+        key = "index-{0}".format(query_window(query))
+        return cache.cached("bugzilla-bugs", key, fetch)
+
+    def covers(self, since):
+        """
+        Does the index contain all bugs changed since a given date? `None`
+        stands for the whole `DAYS_AGO` window.
+        """
+        return not self.since or bool(since and since >= self.since)
+
+    def get_bugs(self, email, since=None):
+        bugs = self.by_assignee.get(email.lower(), [])
+        if since:
+            bugs = [bug for bug in bugs
+                    if as_date(bug.last_change_time) >= since]
+        return bugs
 
 
 class User:
     """
     A high-level abstraction for interacting with users.
+
+    Remote data is remembered per instance. We can't use `cached_property`
+    for it, until Python 3.12 it holds one lock for all instances, so the
+    threads would fetch it one sponsor at a time.
     """
     def __init__(self, username, client, bz):
         self.username = username
         self.client = client
         self.bz = bz
+        self._fas = None
+        self._sponsor_config = MISSING
 
-    @cached_property
+    @property
     def fas(self):
-        return Munch(self.client.get_user(username=self.username).result)
+        if self._fas is None:
+            with backend("fas"):
+                self._fas = Munch(get_fas_user(self.client, self.username))
+        return self._fas
 
-    @cached_property
+    @property
     def human_name(self):
         return self.fas.human_name
 
-    @cached_property
+    @property
     def email(self):
         return self.fas.rhbzemail or self.fas.emails[0]
 
-    @cached_property
+    @property
     def sponsor_config(self):
-        return fetch_personal_config(self.username)
+        if self._sponsor_config is MISSING:
+            with backend("fedorapeople"):
+                self._sponsor_config = fetch_personal_config(self.username)
+        return self._sponsor_config
 
-    @cached_property
+    @property
     def is_active(self):
         # This is probably not correct but it is good enough for now
         return not self.fas.locked and not self.fas.is_private
 
 
-def examine_activity_on_bug(user, bug):
+def get_history(bug):
     """
-    Examine whether a user made any activity on a particular bug and return a
-    boolean value.
+    Fetch the whole history of a bug. It can't change without changing
+    `last_change_time`, so we can cache it for a long time.
     """
+    def fetch():
+        with backend("bugzilla"):
+            return resilience.call("bugzilla", bug.get_history_raw)
 
-    history = bug.get_history_raw()
+    return cache.cached("bugzilla-history", history_key(bug), fetch)
 
-    for change in history["bugs"][0]["history"]:
-        if change["when"] < date.today() - timedelta(DAYS_AGO):
-            continue
+
+def history_key(bug):
+    return "{0}-{1}".format(bug.id, getattr(bug, "last_change_time", None))
+
+
+class BugHistories:
+    """
+    Histories of many bugs at once. Bugzilla's `Bug.history` accepts multiple
+    IDs, so we can fetch them in chunks instead of one XML-RPC call per bug,
+    and then hand them over to `examine_activity_on_bug` from memory.
+    """
+
+    chunk_size = 100
+
+    def __init__(self, bz):
+        self.bz = bz
+        self.histories = {}
+
+    def prefetch(self, bugs):
+        missing = {}
+        for bug in bugs:
+            key = history_key(bug)
+            if key in self.histories:
+                continue
+            history = cache.get("bugzilla-history", key)
+            if history is MISSING:
+                missing[bug.id] = key
+            else:
+                self.histories[key] = history
+
+        ids = sorted(missing)
+        for i in range(0, len(ids), self.chunk_size):
+            chunk = ids[i:i + self.chunk_size]
+            with backend("bugzilla"):
+                response = resilience.call(
+                    "bugzilla", self.bz.bugs_history_raw, chunk)
+            for item in response["bugs"]:
+                # Keep the same format as `Bug.get_history_raw` returns
+                history = {"bugs": [item]}
+                key = missing[item["id"]]
+                cache.set("bugzilla-history", key, history)
+                self.histories[key] = history
+
+    def get(self, bug):
+        history = self.histories.get(history_key(bug))
+        if history is None:
+            history = get_history(bug)
+        return history
+
+
+def as_date(when):
+    """
+    Convert a Bugzilla timestamp (`xmlrpc.client.DateTime` or `datetime`) to
+    a `date` object
+    """
+    return date(*when.timetuple()[:3])
+
+
+# 177841 is FE-NEEDSPONSOR
+FE_NEEDSPONSOR = 177841
+
+# A proof that a sponsor was active. The `rule` is a short description of what
+# they did, see `ACTIVITY_RULES`
+Evidence = namedtuple("Evidence", ["rule", "bug_id", "date"])
+
+
+def gave_review_plus(bug, change):
+    return any(i.get("added") == "fedora-review+" for i in change["changes"])
+
+
+def worked_on_needsponsor(bug, change):
+    # Any change of any field counts
+    if FE_NEEDSPONSOR not in bug.blocks:
+        return False
+    return any("field_name" in i for i in change["changes"])
+
+
+def removed_needsponsor(bug, change):
+    if FE_NEEDSPONSOR in bug.blocks:
+        return False
+    return any(i.get("field_name") == "blocks"
+               and i.get("removed") == str(FE_NEEDSPONSOR)
+               for i in change["changes"])
+
+
+# All the possible kinds of sponsor activity in Bugzilla. Each rule is a tuple
+# of its name, a function deciding whether a change matches it, and a message
+# to be printed when it does
+ACTIVITY_RULES = [
+    ("fedora-review+", gave_review_plus,
+     "{0} <{1}> gave fedora-review+ for BZ {2}"),
+    ("FE-NEEDSPONSOR work", worked_on_needsponsor,
+     "{0} <{1}> worked on BZ {2}"),
+    ("FE-NEEDSPONSOR removal", removed_needsponsor,
+     "{0} <{1}> removed FE-NEEDSPONSOR from BZ {2}"),
+]
+
+
+def examine_activity_on_bug(user, bug, histories=None, cutoff=None):
+    """
+    Examine whether a user made any activity on a particular bug. Return an
+    `Evidence` of the most recent activity or `None`.
+
+    All `ACTIVITY_RULES` are evaluated within a single pass over the bug
+    history, starting from the newest changes.
+    """
+    if not cutoff:
+        cutoff = date.today() - timedelta(DAYS_AGO)
+
+    history = histories.get(bug) if histories else get_history(bug)
+    for change in reversed(history["bugs"][0]["history"]):
+        if change["when"] < cutoff:
+            # The history is sorted, all the other changes are even older
+            break
         if change["who"] != user.email:
             continue
-        for inner_change in change["changes"]:
-            if inner_change["added"] == "fedora-review+":
-                print("{0} <{1}> gave fedora-review+ for BZ {2}".format(user.human_name, user.username, bug.id))
-                return True
-
-    # 177841 is FE-NEEDSPONSOR
-    if 177841 in bug.blocks:
-        # check if sponsor changed status of the bug
-        for change in history['bugs'][0]['history']:
-            if change['when'] > date.today() - timedelta(DAYS_AGO):
-                if change['who'] == user.email:
-                    for i in change['changes']:
-                        if 'field_name' in i:
-                            print(u"{0} <{1}> worked on BZ {2}".format(user.human_name, user.username, bug.id))
-                            return True
-                    else:
-                        continue # hack to break to outer for-loop if we called break 2 lines above
-                    break
-
-    else:
-        # check if sponsor removed FE-NEEDSPONSOR in past one year
-        for change in history['bugs'][0]['history']:
-            if change['when'] > date.today() - timedelta(DAYS_AGO):
-                if change['who'] == user.email:
-                    for i in change['changes']:
-                        if 'removed' in i and 'field_name' in i and \
-            i['removed'] == '177841' and i['field_name'] == 'blocks':
-                            print(u"{0} <{1}> removed FE-NEEDSPONSOR from BZ {2}".format(user.human_name, user.username, bug.id))
-                            return True
-                    else:
-                        continue # hack to break to outer for-loop if we called break 2 lines above
-                    break
-    return False
+        for rule, matches, message in ACTIVITY_RULES:
+            if matches(bug, change):
+                print(message.format(user.human_name, user.username, bug.id))
+                return Evidence(rule, bug.id, as_date(change["when"]))
+    return None
 
 
-def find_directly_sponsored(client):
+def find_directly_sponsored():
     """
-    Query FAS and find what users were sponsored and by whom.
+    Find what users were recently sponsored into the packager group and by
+    whom. The results are stored in `DIRECTLY_SPONSORED`.
     """
     # Previously we used the python-fedora package to query the packager group
-    # members, who sponsored them and when. Since we use fasjson, this is not
-    # possible to do anymore.
-    # https://github.com/fedora-infra/fasjson/issues/522
-    #
-    # We might want to rewrite the code using somethign like
-    # https://gist.github.com/FrostyX/47defa18348fbb917e73d7b2e7660ca2
-    return
+    # members, who sponsored them and when, and then converted the user IDs to
+    # usernames one by one. Fasjson doesn't provide this information, so we
+    # search for sponsorship messages instead. They contain usernames, so
+    # there is nothing to convert.
+    DIRECTLY_SPONSORED.clear()
+    since = date.today() - timedelta(DAYS_AGO)
+    try:
+        with backend("datagrepper"):
+            sponsorships = list_sponsorships("packager", since)
+    # This is only one of the evidence sources, when datagrepper is down,
+    # sends something that isn't JSON, or there is no recording of it, the
+    # others still work
+    except (resilience.Unavailable, requests.RequestException, ValueError,
+            transport.ReplayMiss) as ex:
+        print("Unable to find directly sponsored users: {0}".format(ex))
+        return
 
-    packager_group = client.group_by_name("packager")
-    for role in packager_group.approved_roles:
-        if role.role_type != 'user':
+    for sponsor, username, timestamp in sponsorships:
+        if not sponsor or not username or not timestamp:
             continue
+        when = datetime.fromtimestamp(timestamp).date()
+        DIRECTLY_SPONSORED.setdefault(sponsor, [])
+        DIRECTLY_SPONSORED[sponsor].append((username, when))
 
-        date_format = "%Y-%m-%d %H:%M:%S.%f+00:00"
-        approved_date = datetime.strptime(role.approval, date_format)
-        if approved_date <= datetime.today() - timedelta(DAYS_AGO):
-            continue
 
-        DIRECTLY_SPONSORED.setdefault(role.sponsor_id, [])
-        DIRECTLY_SPONSORED[role.sponsor_id].append(role.person_id)
+def previous_evidence(state, username):
+    """
+    What did the previous run find out about this sponsor? Returns a tuple of
+    their last activity date (if it is still within the `DAYS_AGO` window),
+    the date since when we need to examine Bugzilla changes, and a set of
+    already examined bug IDs.
+    """
+    previous = (state or {}).get(username, {})
+    cutoff = date.today() - timedelta(DAYS_AGO)
+    last_activity = previous.get("last_activity")
+    if last_activity:
+        last_activity = date.fromisoformat(last_activity)
+        if last_activity <= cutoff:
+            last_activity = None
 
+    since = None
+    examined = set()
+    if previous.get("evaluated"):
+        # Go one day back, just to be sure we don't miss anything
+        since = datetime.fromisoformat(previous["evaluated"]).date()
+        since -= timedelta(days=1)
+        examined = set(previous.get("examined", []))
+    return last_activity, since, examined
 
-def process_user(username, client, bz):
+
+def needs_bugzilla(last_activity):
+    """
+    Sponsors without any known recent activity, or with activity that is
+    going to fall out of the window soon, need to be examined in Bugzilla
+    """
+    cutoff = date.today() - timedelta(DAYS_AGO)
+    if not last_activity:
+        return True
+    return last_activity <= cutoff + timedelta(EXPIRY_MARGIN)
+
+
+def process_user(username, client, bz, state=None, index=None,
+                 histories=None, ledger=None, user=None):
     """
     Did this user do any sponsor activity?
+
+    When `state` from the previous run is passed, only the Bugzilla changes
+    made since then are examined, and it is updated in place. All found
+    evidence is recorded into the `ledger`. An already existing `User` can be
+    passed, so that nothing is fetched twice.
     """
     good_guy = False
-    user = User(username, client, bz)
+    user = user or User(username, client, bz)
     if not user.is_active:
         return None
 
     if not user.human_name:
         return None
 
-    # Examine activity in bugzilla
-    for bug in get_bugs(bz, user):
-        good_guy = examine_activity_on_bug(user, bug)
-        if good_guy:
-            break
+    # The evidence sources are ordered from the cheapest one and we stop at
+    # the first positive result
 
-    # Examine sponsorships in FAS
-    # FIXME DIRECTLY_SPONSORED is empty, so we can temporarily disable the code
-    # instead of fixing it
-    # if user.fas.id in DIRECTLY_SPONSORED:
-    #     good_guy = True
-    #     sponsored_users = DIRECTLY_SPONSORED[user.fas.id]
-    #     sponsored_users = [IDtoNameCache.convert_id_to_name(u, client)
-    #                        for u in sponsored_users]
-    #     print("{0} <{1}> - directly sponsored: {2}".format(
-    #         user.human_name, user.username, sponsored_users))
+    # All recent sponsorships are already known, see `find_directly_sponsored`
+    if username in DIRECTLY_SPONSORED:
+        sponsored = DIRECTLY_SPONSORED[username]
+        print("{0} <{1}> - directly sponsored: {2}".format(
+            user.human_name, user.username,
+            ", ".join(sorted({x for x, _ in sponsored}))))
+        if ledger:
+            for _, when in sponsored:
+                ledger.record(username, "direct sponsorship", None, when)
+        # We didn't look into Bugzilla, so let's keep the state from the
+        # previous run as it is
+        return user.fas
 
     # We may not always discover a sponsor's activity accurately and display
     # somebody as inactive even though he isn't.
@@ -213,6 +514,76 @@ def process_user(username, client, bz):
         good_guy = True
         print("{0} <{1}> - has sponsor.yaml on fedorapeople.org"
               .format(user.human_name, user.username))
+        if ledger:
+            ledger.record(username, "sponsor.yaml", None, date.today())
+        # We didn't look into Bugzilla, so let's keep the state from the
+        # previous run as it is
+        return user.fas
+
+    now = datetime.now()
+    cutoff = date.today() - timedelta(DAYS_AGO)
+    last_activity, since, examined = previous_evidence(state, username)
+    evidence = None
+    queried = needs_bugzilla(last_activity)
+
+    if not queried:
+        good_guy = True
+        print("{0} <{1}> - active on {2}, according to the previous run"
+              .format(user.human_name, user.username, last_activity))
+        # The ledger may not exist yet, when the state already does
+        previous = state.get(username, {})
+        if ledger and previous.get("rule"):
+            ledger.record(username, previous["rule"], previous.get("bug"),
+                          last_activity)
+
+    # Examine activity in bugzilla, the most recently changed bugs first
+    else:
+        bugs = get_bugs(bz, user, since=since, index=index)
+        bugs = [bug for bug in bugs if not (
+            since and bug.id in examined and
+            as_date(bug.last_change_time) < since)]
+        bugs.sort(key=lambda bug: str(bug.last_change_time), reverse=True)
+        if histories:
+            histories.prefetch(bugs)
+        for bug in bugs:
+            # Bugs are sorted by their last change, so the first evidence isn't
+            # necessarily the newest one. But once a bug wasn't changed after
+            # the evidence we have, none of the remaining bugs can have a newer
+            # one. The state must remember the newest evidence, otherwise the
+            # sponsor would expire too soon.
+            if evidence and as_date(bug.last_change_time) <= evidence.date:
+                break
+            examined.add(bug.id)
+            found = examine_activity_on_bug(user, bug, histories, cutoff)
+            if not found:
+                continue
+            if ledger:
+                ledger.record(username, *found)
+            if not evidence or found.date > evidence.date:
+                evidence = found
+        if evidence:
+            last_activity = max(evidence.date, last_activity or evidence.date)
+        good_guy = bool(last_activity)
+
+    # When we didn't look into Bugzilla, the state from the previous run stays
+    # as it is. Otherwise the next run would skip the changes made since then.
+    if state is not None and queried:
+        # Remember what made the sponsor active, either now or previously
+        previous = state.get(username, {})
+        if evidence and evidence.date == last_activity:
+            rule, bug_id = evidence.rule, evidence.bug_id
+        elif last_activity:
+            rule, bug_id = previous.get("rule"), previous.get("bug")
+        else:
+            rule, bug_id = None, None
+
+        state[username] = {
+            "evaluated": now.isoformat(),
+            "last_activity": last_activity.isoformat() if last_activity else None,
+            "rule": rule,
+            "bug": bug_id,
+            "examined": sorted(examined),
+        }
 
     if not good_guy:
         print("{0} <{1}> - no recent sponsor activity".format(
@@ -221,16 +592,23 @@ def process_user(username, client, bz):
     return user.fas if good_guy else False
 
 
-def process_user_safe(username, client, bz):
+def process_user_safe(username, client, bz, state=None, index=None,
+                      histories=None, ledger=None, user=None):
     """
     Obtaining person information can fail because temporary network issues or
-    server overload. Try again until we get the info successfully.
+    server overload. All remote calls are retried (see `resilience`) but when
+    a backend is down for good, we return `UNKNOWN` instead of waiting forever.
+    Errors that retrying can't fix (e.g. a Bugzilla fault or a user that was
+    removed from FAS in the meantime) make the sponsor `UNKNOWN` too, instead
+    of failing the whole scan.
     """
     try:
-        return process_user(username, client, bz)
-    except requests.RequestException:
-        time.sleep(5)
-        return process_user_safe(username, client, bz)
+        with stats.sponsor(username):
+            return process_user(username, client, bz, state, index, histories,
+                                ledger, user)
+    except (resilience.Unavailable, xmlrpc.client.Error, APIError) as ex:
+        print("{0} - unknown, giving up because of {1}".format(username, ex))
+        return UNKNOWN
 
 
 def config_value(raw_config, key):
@@ -249,10 +627,10 @@ def dump(users, filename, as_json=False):
     Write sponsors into an output file
     """
     here = os.path.dirname(os.path.realpath(__file__))
-    dstdir = os.path.join(here, "_build")
+    dst = os.path.join(here, "_build", filename)
+    dstdir = os.path.dirname(dst)
     if not os.path.exists(dstdir):
         os.makedirs(dstdir)
-    dst = os.path.join(dstdir, filename)
     with open(dst, "w") as f:
         if as_json:
             json.dump(users, f)
@@ -260,33 +638,467 @@ def dump(users, filename, as_json=False):
             f.write("\n".join(users) + "\n")
 
 
-def main():
-    bz = bugzilla.Bugzilla(url='https://bugzilla.redhat.com/xmlrpc.cgi')
+def bugzilla_candidates(users, state, configs=None):
+    """
+    Usernames of sponsors that are going to be examined in Bugzilla, see
+    `process_user`. The `users` is a dict of `User` objects.
 
-    client = Client("https://fasjson.fedoraproject.org")
-    sponsors = client.list_group_sponsors(groupname="packager").result
-    usernames = [x["username"] for x in sponsors]
+    When the personal `configs` are not known yet, sponsors without any
+    previous state are left out, most of them have a sponsor.yaml. They query
+    Bugzilla on their own if they need to, see `ReviewBugsIndex.covers`.
+    Without any state at all (the first or a `--full` run), all of them stay.
+    """
+    candidates = []
+    for username, user in users.items():
+        if username in DIRECTLY_SPONSORED:
+            continue
+        last_activity, _, _ = previous_evidence(state, username)
+        if not needs_bugzilla(last_activity):
+            continue
+        if configs is None:
+            if state and username not in state:
+                continue
+        elif configs.get(username):
+            continue
+        try:
+            if not user.is_active or not user.human_name:
+                continue
+        # They are going to be unknown, see `process_user_safe`
+        except (resilience.Unavailable, APIError):
+            continue
+        candidates.append(username)
+    return candidates
+
+
+def build_index(bz, state, candidates):
+    """
+    Fetch the review bugs of all `candidates` (see `bugzilla_candidates`) at
+    once. Return `None` when Bugzilla is unavailable, the sponsors then query
+    it one by one.
+    """
+    try:
+        with stats.stage("activity.index"):
+            return ReviewBugsIndex(bz, since=index_since(state, candidates))
+    except resilience.Unavailable as ex:
+        print("Unable to fetch all review bugs at once: {0}".format(ex))
+        return None
 
-    find_directly_sponsored(client)
 
+def prefetch_histories(candidates, users, histories, index, state):
+    """
+    Collect bugs of all `candidates` (see `bugzilla_candidates`) from the
+    `index` and fetch their histories at once. Pass the same `users` (a dict
+    of `User` objects) to `process_user` afterwards, so that they are not
+    fetched twice.
+    """
+    def candidate_bugs(username):
+        _, since, _ = previous_evidence(state, username)
+        # The sponsor is going to query Bugzilla on their own
+        if not index.covers(since):
+            return []
+        return index.get_bugs(users[username].email, since)
+
+    histories.prefetch(
+        [bug for username in candidates for bug in candidate_bugs(username)])
+
+
+def process_users(usernames, client, bz, workers=1, state=None,
+                  index=None, histories=None, batch_size=50, ledger=None,
+                  users=None, configs=None):
+    """
+    Run `process_user_safe` for all `usernames`, possibly in parallel. Return a
+    dict mapping usernames to their results. Results are printed as soon as
+    they are known, so they don't come in any particular order.
+
+    When both `index` and `histories` are specified, sponsors are processed in
+    batches and bug histories for each batch are fetched at once beforehand.
+    Already existing `User` objects and personal `configs` can be passed.
+    """
+    def batches():
+        if not (index and histories):
+            yield usernames
+            return
+        for i in range(0, len(usernames), batch_size):
+            yield usernames[i:i + batch_size]
+
+    results = {}
+    users = users or {username: User(username, client, bz)
+                      for username in usernames}
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    for batch in batches():
+        if index and histories:
+            try:
+                candidates = bugzilla_candidates(
+                    {x: users[x] for x in batch}, state or {}, configs)
+                prefetch_histories(candidates, users, histories, index,
+                                   state or {})
+            # Not a big deal, histories will be fetched one by one later
+            except (resilience.Unavailable, xmlrpc.client.Error,
+                    APIError) as ex:
+                print("Unable to prefetch bug histories: {0}".format(ex))
+
+        if not executor:
+            for username in batch:
+                results[username] = process_user_safe(
+                    username, client, bz, state, index, histories, ledger,
+                    users[username])
+            continue
+
+        futures = {executor.submit(process_user_safe, username, client, bz,
+                                   state, index, histories, ledger,
+                                   users[username]): username
+                   for username in batch}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    if executor:
+        executor.shutdown()
+    return results
+
+
+def state_path():
+    here = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(here, "_build", "activity-state.json")
+
+
+def load_active_usernames():
+    """
+    Load the sponsors that were active according to the previous run
+    """
+    here = os.path.dirname(os.path.realpath(__file__))
+    path = os.path.join(here, "_build", "active-sponsors.list")
+    try:
+        with open(path, "r") as f:
+            return {x.strip() for x in f if x.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def previously_active(username, state, active_usernames):
+    """
+    Should a sponsor that we were unable to examine stay active? A backend
+    outage must not make them look inactive on the site, so we trust the
+    previous run, as long as its evidence is still within the window.
+    """
+    last_activity, _, _ = previous_evidence(state, username)
+    return bool(last_activity) or username in active_usernames
+
+
+def load_state():
+    """
+    Load what we learned about sponsors during the previous run
+    """
+    try:
+        with open(state_path(), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def index_since(state, candidates):
+    """
+    The bulk query needs to cover the sponsor that was evaluated the longest
+    time ago, out of those that are going to query Bugzilla (see
+    `bugzilla_candidates`). Returns `None` if the whole `DAYS_AGO` window is
+    needed.
+    """
+    # Without any state (the first or a `--full` run), nobody was evaluated,
+    # even when the candidates are not known yet
+    if not state:
+        return None
+    evaluated = [state.get(username, {}).get("evaluated")
+                 for username in candidates]
+    if not all(evaluated):
+        return None
+    if not evaluated:
+        # Nobody needs the index, but let's keep it valid
+        return date.today() - timedelta(days=1)
+    since = datetime.fromisoformat(min(evaluated)).date()
+    return since - timedelta(days=1)
+
+
+def parse_shard(value):
+    try:
+        index, total = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected I/N, e.g. 0/4")
+    if not 0 <= index < total:
+        raise argparse.ArgumentTypeError("Shard index must be in 0..N-1")
+    return index, total
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Find out which packager sponsors are active")
+    parser.add_argument(
+        "--workers", type=int, default=8,
+        help="How many sponsors should be processed in parallel")
+    parser.add_argument(
+        "--full", action="store_true",
+        help=("Ignore the state from the previous run and examine the whole "
+              "{0} days window for every sponsor".format(DAYS_AGO)))
+    parser.add_argument(
+        "--shard", type=parse_shard, metavar="I/N",
+        help=("Examine only the I-th of N shards of sponsors and dump a "
+              "partial result into {0}".format(shards_dir())))
+    parser.add_argument(
+        "--merge", action="store_true",
+        help="Merge partial results of all shards and exit")
+    parser.add_argument(
+        "--profile", metavar="STAGE",
+        help="Capture cProfile data of a stage, e.g. activity.sponsors")
+    parser.add_argument(
+        "--per-sponsor-queries", action="store_true",
+        help=("Query Bugzilla separately for each sponsor instead of fetching "
+              "all recent review bugs at once"))
+    for name, limit in BACKEND_CONCURRENCY.items():
+        parser.add_argument(
+            "--{0}-concurrency".format(name), type=int, default=limit,
+            help="Maximum number of parallel requests to {0}".format(name))
+    return parser.parse_args()
+
+
+def in_shard(username, shard):
+    """
+    Does the user belong to a given shard? Shard is a tuple of its index and
+    the total number of shards. Python's `hash` is randomized for every
+    process, so we need something stable.
+    """
+    index, total = shard
+    return zlib.crc32(username.encode("utf-8")) % total == index
+
+
+def shards_dir():
+    here = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(here, "_build", "shards")
+
+
+def shard_filename(shard):
+    return "activity-{0}-of-{1}.json".format(*shard)
+
+
+def find_active_sponsors(usernames, client, bz, workers=8, full=False,
+                         per_sponsor_queries=False, shard=None, configs=None,
+                         started=None):
+    """
+    Examine all the sponsors, dump the results into the `_build` directory
+    and return the list of active sponsors. Personal configs are downloaded
+    unless they are passed.
+
+    If a `shard` is specified, examine only the sponsors that belong to it and
+    dump only a partial result, see `merge_shards`. Everything that was cached
+    since the `started` timestamp is exported along with it.
+    """
+    started = started or time.time()
+    roster = usernames
+    if shard:
+        usernames = [x for x in usernames if in_shard(x, shard)]
+    users = {username: User(username, client, bz) for username in usernames}
+
+    find_directly_sponsored()
+
+    state = {} if full else load_state()
+
+    # We need to know who has a sponsor.yaml before deciding how old bugs
+    # the index needs, they don't query Bugzilla at all
+    if configs is None:
+        with stats.stage("activity.configs"):
+            configs, _ = fetch_personal_configs(
+                usernames, workers=backend_limit("fedorapeople"))
+
+    index = None
+    if not per_sponsor_queries:
+        candidates = bugzilla_candidates(users, state, configs)
+        index = build_index(bz, state, candidates)
+
+    return examine_sponsors(roster, users, client, bz, state, index,
+                            workers=workers, shard=shard, started=started,
+                            configs=configs)
+
+
+def examine_sponsors(roster, users, client, bz, state, index,
+                     histories=None, workers=8, shard=None, started=None,
+                     configs=None):
+    """
+    Examine all the `users` (a dict of `User` objects), dump the results and
+    return the list of active sponsors, see `find_active_sponsors`
+    """
+    usernames = list(users)
+    histories = histories or BugHistories(bz)
+    ledger = Ledger()
+    with stats.stage("activity.sponsors"):
+        results = process_users(usernames, client, bz, workers=workers,
+                                state=state, index=index, histories=histories,
+                                ledger=ledger, users=users, configs=configs)
+
+    # Threads finish in random order but we want the output to be stable
     good_guys = []
+    unknown = []
+    previous = load_active_usernames()
     for sponsor in usernames:
-        good_guy = process_user_safe(sponsor, client, bz)
+        good_guy = results[sponsor]
+        if good_guy is UNKNOWN:
+            unknown.append(sponsor)
+            if previously_active(sponsor, state, previous):
+                print("{0} - unknown, active according to the previous run"
+                      .format(sponsor))
+                good_guys.append(sponsor)
+            continue
         if not good_guy:
             continue
         good_guys.append(good_guy.username)
 
+    state = {k: v for k, v in state.items() if k in users}
+
+    if shard:
+        partial = {
+            "shard": list(shard),
+            "roster": roster,
+            "active": good_guys,
+            "unknown": unknown,
+            "state": state,
+            # Each shard has its own ledger, the evidence is recorded into
+            # the main one in `merge_shards`
+            "evidence": [[x.sponsor, x.rule, x.bug_id, x.date.isoformat()]
+                         for x in ledger.recorded],
+        }
+        dump(partial, os.path.join("shards", shard_filename(shard)),
+             as_json=True)
+        # Shards may run on different machines, send what they downloaded
+        # along with the results, so that the cache survives the merge
+        cache.export(os.path.join(shards_dir(), "cache"), started)
+        ledger.close()
+        return good_guys
+
+    dump_results(roster, good_guys, unknown, state)
+    report_expiring(ledger, good_guys)
+    ledger.close()
+    return good_guys
+
+
+def dump_results(usernames, good_guys, unknown, state):
     # Dump the list of active sponsors
     dump(good_guys, "active-sponsors.list")
 
+    # And the sponsors we were unable to examine
+    dump(unknown, "unknown-sponsors.list")
+
     # And dump the list of all sponsors for a good measure
     dump(usernames, "sponsors.list")
 
+    # Remember what we found out so that the next run can be incremental
+    dump(state, os.path.basename(state_path()), as_json=True)
+
     # And dump additional user information as JSON
     # I had some sort of intention with this bug I left it WIP and I now cannot
     # remember what information I wanted to dump and why
     # dump(sponsors, "bugzilla-sponsors.json", as_json=True)
 
 
+def report_expiring(ledger, usernames):
+    """
+    Print active sponsors whose evidence falls out of the `DAYS_AGO` window
+    soon, unless they do something
+    """
+    usernames = set(usernames)
+    expiring = [(sponsor, when) for sponsor, when
+                in ledger.expiring(DAYS_AGO, EXPIRY_MARGIN)
+                if sponsor in usernames]
+    if not expiring:
+        return
+    print("Sponsors whose last known activity expires within {0} days:"
+          .format(EXPIRY_MARGIN))
+    for sponsor, when in expiring:
+        print("  {0} - last active on {1}".format(sponsor, when))
+
+
+def merge_shards(directory=None):
+    """
+    Combine partial results of all shards into the same files that a
+    non-sharded run produces
+    """
+    directory = directory or shards_dir()
+    partials = []
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith("activity-") or not name.endswith(".json"):
+            continue
+        with open(os.path.join(directory, name), "r") as f:
+            partials.append(json.load(f))
+
+    if not partials:
+        raise RuntimeError("No shards found in {0}".format(directory))
+
+    total = partials[0]["shard"][1]
+    found = {partial["shard"][0] for partial in partials
+             if partial["shard"][1] == total}
+    if found != set(range(total)) or len(partials) != total:
+        raise RuntimeError("Expected {0} shards, found {1}".format(
+            total, [shard_filename(x["shard"]) for x in partials]))
+
+    cache.merge(os.path.join(directory, "cache"))
+
+    roster = partials[0]["roster"]
+    active, unknown, state = set(), set(), {}
+    ledger = Ledger()
+    for partial in partials:
+        active.update(partial["active"])
+        unknown.update(partial["unknown"])
+        state.update(partial["state"])
+        for sponsor, rule, bug_id, when in partial.get("evidence", []):
+            ledger.record(sponsor, rule, bug_id, date.fromisoformat(when))
+
+    good_guys = [x for x in roster if x in active]
+    dump_results(
+        roster,
+        good_guys,
+        [x for x in roster if x in unknown],
+        state,
+    )
+    report_expiring(ledger, good_guys)
+    ledger.close()
+
+
+def main():
+    # Shards export all cache entries used since now, including the roster
+    # and FAS users fetched below
+    started = time.time()
+    transport.install_from_environment()
+    metrics.install()
+    args = parse_args()
+    if args.profile:
+        stats.profile_stage = args.profile
+    if args.merge:
+        merge_shards()
+        return
+
+    set_backend_concurrency({
+        name: getattr(args, "{0}_concurrency".format(name))
+        for name in BACKEND_CONCURRENCY
+    })
+
+    try:
+        bz = resilience.call("bugzilla", bugzilla.Bugzilla,
+                             url='https://bugzilla.redhat.com/xmlrpc.cgi')
+    except resilience.Unavailable as ex:
+        print("Unable to connect to Bugzilla, try again. {0}".format(ex))
+        sys.exit(1)
+
+    client = Client("https://fasjson.fedoraproject.org")
+    usernames = get_sponsors_usernames(client)
+
+    with stats.stage("activity"):
+        # Fetch all the sponsors at once, `User.fas` then takes them from memory
+        with stats.stage("activity.fas"):
+            mine = [x for x in usernames
+                    if not args.shard or in_shard(x, args.shard)]
+            get_fas_users(client, mine, workers=args.fas_concurrency)
+
+        find_active_sponsors(usernames, client, bz, workers=args.workers,
+                             full=args.full,
+                             per_sponsor_queries=args.per_sponsor_queries,
+                             shard=args.shard, started=started)
+    stats.dump("activity")
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,283 @@
+"""
+Benchmark the most expensive parts of the pipeline on synthetic data
+
+Every benchmark runs for each of the requested sizes (number of sponsors)
+and the results are saved as JSON, so they can be compared between commits
+
+    $ python benchmark.py --sizes 100,1000 --output before.json
+    $ git checkout ...
+    $ python benchmark.py --sizes 100,1000 --compare before.json
+
+No network access is needed.
+"""
+
+import io
+import os
+import json
+import time
+import hashlib
+import tempfile
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime
+from types import SimpleNamespace
+
+import yaml
+
+import synthetic
+import activity
+import sponsors
+from cache import cache
+
+
+def offline_libravatar_url(email, size, default):
+    """
+    The real `libravatar_url` queries DNS for every sponsor, we would be
+    measuring the network
+    """
+    digest = hashlib.md5(email.encode("utf-8")).hexdigest()
+    return "https://seccdn.libravatar.org/avatar/{0}?s={1}&d={2}".format(
+        digest, size, default)
+
+
+def make_sponsors(size):
+    sponsors.libravatar_url = offline_libravatar_url
+    users = synthetic.generate_users(size)
+    for i, user in enumerate(users):
+        # Don't let `_build_sponsors_json` talk to Bugzilla
+        sponsors.BUGZILLA_USER_IDS[user["emails"][0]] = i
+    return [sponsors.Sponsor(user) for user in users]
+
+
+def bench_examine_activity_on_bug(size, args):
+    bugs, histories = [], {}
+    for i in range(size):
+        bug, history = synthetic.generate_bug(
+            i, "assignee@example.com", args.history_depth,
+            active=i % 2 == 0, seed=i)
+        bugs.append(bug)
+        histories[bug.id] = history
+
+    user = SimpleNamespace(email="assignee@example.com",
+                           username="assignee", human_name="Assignee")
+    histories = synthetic.StaticHistories(histories)
+
+    def run():
+        for bug in bugs:
+            activity.examine_activity_on_bug(user, bug, histories)
+    return run
+
+
+def bench_sponsors_from_yaml(size, args):
+    items = make_sponsors(size)
+    usernames = [x.username for x in items]
+    groups = synthetic.generate_groups(usernames, args.groups,
+                                       members=max(1, size // 10))
+    path = os.path.join(args.tmpdir, "groups-{0}.yaml".format(size))
+    with open(path, "w") as f:
+        yaml.dump(groups, f)
+
+    active = synthetic.generate_active_usernames(usernames)
+    registry = sponsors.SponsorRegistry(items, active)
+
+    def run():
+        sponsors.sponsors_from_yaml(path, registry)
+    return run
+
+
+def bench_sponsor_registry(size, args):
+    items = make_sponsors(size)
+    active = synthetic.generate_active_usernames([x.username for x in items])
+
+    def run():
+        sponsors.SponsorRegistry(items, active)
+    return run
+
+
+def bench_sponsors_by_timezone(size, args):
+    items = make_sponsors(size)
+
+    def run():
+        sponsors.sponsors_by_timezone(items)
+    return run
+
+
+def make_data(size, args):
+    items = make_sponsors(size)
+    usernames = [x.username for x in items]
+    active = synthetic.generate_active_usernames(usernames)
+    registry = sponsors.SponsorRegistry(items, active)
+    groups = synthetic.generate_groups(usernames, args.groups,
+                                       members=max(1, size // 10))
+    return {
+        "sponsors": registry.sponsors,
+        "active": sponsors.active_sponsors(registry),
+        "interests": sponsors.sponsors_from_config(groups, registry),
+        "regions": sponsors.sponsors_by_region(registry.sponsors),
+        "timezones": sponsors.sponsors_by_timezone(registry.sponsors),
+        "languages": sponsors.sponsors_from_config(groups, registry),
+        "build_tag": sponsors.build_tag(),
+        "build_timestamp": datetime.now(),
+    }
+
+
+def bench_render_templates(size, args):
+    data = make_data(size, args)
+
+    def run():
+        # Render the cards once and reuse them, the same way `build_page` does
+        engine = sponsors.RenderEngine(data)
+        builder = sponsors.HtmlBuilder(data, engine)
+        for name in engine.templates:
+            builder.render_template(
+                name,
+                options=builder.options,
+                builddir_rel_path=builder.builddir_rel_path(name),
+                cards=engine.cards,
+                **data
+            )
+    return run
+
+
+def bench_build_sponsors_json(size, args):
+    data = make_data(size, args)
+
+    def run():
+        # The result is cached in the engine, so we need a new one every time
+        sponsors.RenderEngine(data).sponsors_json
+    return run
+
+
+BENCHMARKS = {
+    "examine_activity_on_bug": bench_examine_activity_on_bug,
+    "sponsors_from_yaml": bench_sponsors_from_yaml,
+    "sponsor_registry": bench_sponsor_registry,
+    "sponsors_by_timezone": bench_sponsors_by_timezone,
+    "render_templates": bench_render_templates,
+    "build_sponsors_json": bench_build_sponsors_json,
+}
+
+
+def measure(run, repeat):
+    """
+    Run the function `repeat` times and return the durations in seconds
+    """
+    durations = []
+    for _ in range(repeat):
+        # The measured code likes to print, we don't want to measure that
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            stderr=subprocess.DEVNULL)
+        return output.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path, "r") as f:
+        previous = json.load(f)["results"]
+
+    print("\nCompared to {0}".format(path))
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            old = previous.get(name, {}).get(size)
+            if not old:
+                continue
+            ratio = result["median"] / old["median"] if old["median"] else 0
+            print("{0:30} {1:>7} {2:8.2f}x".format(name, size, ratio))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic data")
+    parser.add_argument(
+        "--sizes", default="100,1000,10000",
+        help="Comma-separated numbers of sponsors")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="How many times to run each benchmark")
+    parser.add_argument(
+        "--history-depth", type=int, default=50,
+        help="How many changes every synthetic bug has")
+    parser.add_argument(
+        "--groups", type=int, default=50,
+        help="How many interests/languages groups to generate")
+    parser.add_argument(
+        "--only", action="append", choices=BENCHMARKS.keys(),
+        help="Run only the given benchmark, can be used multiple times")
+    parser.add_argument(
+        "--output",
+        help="Where to save the results, defaults to _build/benchmarks/")
+    parser.add_argument(
+        "--compare", metavar="FILE",
+        help="Compare the results with previously saved ones")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    # We want to measure the work, not the cache
+    cache.enabled = False
+    names = args.only or list(BENCHMARKS)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.tmpdir = tmpdir
+        for name in names:
+            results[name] = {}
+            for size in sizes:
+                run = BENCHMARKS[name](size, args)
+                durations = measure(run, args.repeat)
+                results[name][str(size)] = {
+                    "min": min(durations),
+                    "median": statistics.median(durations),
+                    "mean": statistics.mean(durations),
+                }
+                print("{0:30} {1:>7} {2:10.4f}s".format(
+                    name, size, results[name][str(size)]["median"]))
+
+    commit = git_commit()
+    now = datetime.now()
+    output = args.output
+    if not output:
+        here = os.path.dirname(os.path.realpath(__file__))
+        output = os.path.join(here, "_build", "benchmarks", "{0}-{1}.json"
+                              .format(now.strftime("%Y%m%d-%H%M%S"), commit))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": now.isoformat(),
+            "python": platform.python_version(),
+            "parameters": {
+                "sizes": sizes,
+                "repeat": args.repeat,
+                "history_depth": args.history_depth,
+                "groups": args.groups,
+            },
+            "results": results,
+        }, f, indent=2)
+    print("Results saved to {0}".format(output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
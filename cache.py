@@ -0,0 +1,192 @@
+"""
+Persistent on-disk cache for responses from FAS, Bugzilla, and
+fedorapeople.org
+
+All the `make` stages (activity, groups, build) need mostly the same data, so
+they read it through this cache and one pipeline run asks each remote
+resource only once. Set `FEDORA_SPONSORS_NO_CACHE=1` to bypass it.
+"""
+
+import os
+import time
+import pickle
+import shutil
+import hashlib
+import threading
+
+
+# How long (in seconds) is each kind of data considered fresh
+TTL = {
+    "fas-sponsors": 6 * 3600,
+    "fas-user": 24 * 3600,
+    "fedorapeople": 12 * 3600,
+    "fedorapeople-validators": 90 * 24 * 3600,
+    "bugzilla-bugs": 6 * 3600,
+    "bugzilla-history": 30 * 24 * 3600,
+    "bugzilla-user": 90 * 24 * 3600,
+    "sponsor-card": 30 * 24 * 3600,
+    "datagrepper-sponsorships": 6 * 3600,
+}
+
+# Most sponsors don't have any sponsor.yaml on fedorapeople.org, remembering
+# that something doesn't exist is as valuable as remembering its content
+NEGATIVE_TTL = 12 * 3600
+
+# When the cache grows over this size, the least recently used entries are
+# thrown away
+MAX_SIZE = 256 * 1024 * 1024
+
+# Returned by `Cache.get` when there is no fresh entry. We can't use `None`
+# because that is a valid (negative) value
+MISSING = object()
+
+
+def default_cachedir():
+    here = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(here, "_build", "cache")
+
+
+class Cache:
+    """
+    A simple key-value store, one pickled file per entry
+    """
+
+    def __init__(self, path=None, max_size=MAX_SIZE):
+        self.path = path or default_cachedir()
+        self.max_size = max_size
+        self.enabled = not os.environ.get("FEDORA_SPONSORS_NO_CACHE")
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _entry_path(self, kind, key):
+        digest = hashlib.sha1(str(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, kind, digest)
+
+    def get(self, kind, key):
+        """
+        Return the cached value or `MISSING` if there is no fresh entry
+        """
+        if not self.enabled:
+            return MISSING
+
+        path = self._entry_path(kind, key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return MISSING
+
+        ttl = NEGATIVE_TTL if entry["value"] is None else TTL[kind]
+        if time.time() - entry["stored"] > ttl:
+            return MISSING
+
+        # Access time is not reliable on all filesystems, so we use
+        # modification time to find the least recently used entries
+        try:
+            os.utime(path)
+        # Another thread may have evicted it in the meantime
+        except FileNotFoundError:
+            pass
+        return entry["value"]
+
+    def set(self, kind, key, value):
+        if not self.enabled:
+            return
+
+        path = self._entry_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {"stored": time.time(), "key": key, "value": value}
+        tmp = "{0}.{1}.tmp".format(path, threading.get_ident())
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f)
+        size = os.path.getsize(tmp)
+
+        with self._lock:
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp, path)
+
+            if self._size is None:
+                self._size = self._compute_size()
+            else:
+                self._size += size - replaced
+            if self._size > self.max_size:
+                self._evict()
+
+    def cached(self, kind, key, fetch):
+        """
+        Return the cached value or call `fetch()`, store its result and return
+        it. A `None` result is cached with `NEGATIVE_TTL`.
+        """
+        value = self.get(kind, key)
+        if value is MISSING:
+            value = fetch()
+            self.set(kind, key, value)
+        return value
+
+    def export(self, directory, since):
+        """
+        Copy entries that were written or read since a given time into
+        another directory, see `merge`
+        """
+        for path, stat in self._entries():
+            if stat.st_mtime < since or path.endswith(".tmp"):
+                continue
+            dst = os.path.join(directory, os.path.relpath(path, self.path))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(path, dst)
+
+    def merge(self, directory):
+        """
+        Copy entries exported by another process into this cache. When both
+        have the same entry, the more recently used one wins.
+        """
+        if not self.enabled:
+            return
+
+        for root, _, files in os.walk(directory):
+            for name in files:
+                src = os.path.join(root, name)
+                dst = os.path.join(self.path, os.path.relpath(src, directory))
+                if os.path.exists(dst) and \
+                        os.path.getmtime(dst) >= os.path.getmtime(src):
+                    continue
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(src, dst)
+
+        with self._lock:
+            self._size = self._compute_size()
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat
+
+    def _compute_size(self):
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _evict(self):
+        # Remove the least recently used entries until we get safely below
+        # the limit, so we don't need to evict on every write
+        entries = sorted(self._entries(), key=lambda x: x[1].st_mtime)
+        target = self.max_size * 0.9
+        for path, stat in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= stat.st_size
+
+
+cache = Cache()
@@ -1,30 +1,308 @@
 import os
 import yaml
+import threading
 import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from fasjson_client import Client
+from fasjson_client.errors import APIError
+from cache import cache, MISSING
+import resilience
+import transport
+import metrics
+from metrics import metrics as stats
 
 
-def get_sponsors_usernames():
-    client = Client("https://fasjson.fedoraproject.org/")
-    return [sponsor["username"] for sponsor in
-            client.list_group_sponsors(groupname="packager").result]
+# How many seconds to wait for a fedorapeople.org response
+FETCH_TIMEOUT = 10
+
+# How many sponsor.yaml files to download in parallel
+FETCH_WORKERS = 16
+
+# Only these FAS fields are needed to build the site and to examine activity
+FAS_USER_FIELDS = [
+    "username",
+    "human_name",
+    "emails",
+    "rhbzemail",
+    "timezone",
+    "ircnicks",
+    "github_username",
+    "gitlab_username",
+    "website",
+    "locked",
+    "is_private",
+]
+
+# Datagrepper remembers all messages sent to the Fedora message bus
+DATAGREPPER_URL = "https://apps.fedoraproject.org/datagrepper/raw"
+
+# Searching a long time range takes a while
+DATAGREPPER_TIMEOUT = 60
+
+# Datagrepper doesn't allow bigger pages
+DATAGREPPER_PAGE_SIZE = 100
+
+# Sent by FAS every time a sponsor adds somebody to a group
+SPONSOR_TOPIC = "org.fedoraproject.prod.fas.group.member.sponsor"
+
+# FAS users fetched during this run, see `get_fas_users`
+FAS_USERS = {}
+
+# Personal configs fetched during this run, see `fetch_personal_configs`
+PERSONAL_CONFIGS = {}
+
+_local = threading.local()
+
+
+def get_sponsors_usernames(client=None):
+    def fetch():
+        # The same request gives us the sponsors' FAS information too
+        sponsors = list_group_sponsors(client, "packager")
+        remember_fas_users(sponsors)
+        return [sponsor["username"] for sponsor in sponsors]
+
+    client = client or Client("https://fasjson.fedoraproject.org/")
+    return cache.cached("fas-sponsors", "packager", fetch)
+
+
+def get_fas_user(client, username):
+    """
+    Return a dict with FAS information about a given user
+    """
+    def fetch():
+        return resilience.call(
+            "fas", client.get_user, username=username).result
+
+    if username not in FAS_USERS:
+        FAS_USERS[username] = cache.cached("fas-user", username, fetch)
+    return FAS_USERS[username]
+
+
+def list_group_sponsors(client, groupname):
+    """
+    Return all sponsors of a FAS group with only the `FAS_USER_FIELDS`
+    """
+    mask = "{{{0}}}".format(",".join(FAS_USER_FIELDS))
+    response = resilience.call(
+        "fas", client.list_group_sponsors,
+        groupname=groupname,
+        _request_options={"headers": {"X-Fields": mask}},
+    )
+    return response.result
+
+
+def remember_fas_users(users):
+    """
+    Store users from a bulk listing so that `get_fas_user` doesn't need to
+    fetch them again
+    """
+    for user in users:
+        # Private users don't show their emails in listings
+        if not user.get("emails"):
+            continue
+        FAS_USERS[user["username"]] = user
+        cache.set("fas-user", user["username"], user)
+
+
+def get_fas_users(client, usernames, groupname="packager", workers=8):
+    """
+    Return a dict with FAS information about all given users, indexed by
+    their usernames.
+
+    All the group sponsors are fetched in one request, and only the users
+    that this missed are fetched one by one, in parallel.
+    """
+    missing = set()
+    for username in usernames:
+        user = FAS_USERS.get(username, cache.get("fas-user", username))
+        if user is MISSING:
+            missing.add(username)
+        else:
+            FAS_USERS[username] = user
+
+    try:
+        if missing:
+            listed = list_group_sponsors(client, groupname)
+            remember_fas_users([x for x in listed if x["username"] in missing])
+            missing -= set(FAS_USERS)
+    except (resilience.Unavailable, APIError) as ex:
+        print("Unable to list {0} sponsors: {1}".format(groupname, ex))
+
+    def fetch(username):
+        try:
+            get_fas_user(client, username)
+        except (resilience.Unavailable, APIError) as ex:
+            print("Unable to get {0} from FAS: {1}".format(username, ex))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fetch, sorted(missing)))
+
+    # Users that we were unable to fetch (e.g. because they were removed from
+    # FAS in the meantime) are missing in the result, callers that can't do
+    # without them must check
+    return {username: FAS_USERS[username] for username in usernames
+            if username in FAS_USERS}
+
+
+def list_sponsorships(groupname, since):
+    """
+    Return a list of `(sponsor, user, timestamp)` tuples for everybody who
+    was sponsored into a FAS group since a given date.
+
+    Fasjson doesn't know who sponsored whom, see
+    https://github.com/fedora-infra/fasjson/issues/522
+    but FAS announces every sponsorship on the message bus, so we can search
+    them in datagrepper, one page at a time.
+    """
+    start = datetime(since.year, since.month, since.day).timestamp()
+
+    def fetch_page(page):
+        params = {
+            "topic": SPONSOR_TOPIC,
+            "start": int(start),
+            "rows_per_page": DATAGREPPER_PAGE_SIZE,
+            "page": page,
+            "order": "asc",
+        }
+        response = get_session().get(DATAGREPPER_URL, params=params,
+                                     timeout=DATAGREPPER_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    def fetch():
+        result = []
+        page = 1
+        while True:
+            data = resilience.call("datagrepper", fetch_page, page)
+            for message in data.get("raw_messages", []):
+                body = message.get("msg") or {}
+                body = body.get("msg", body)
+                if body.get("group") != groupname:
+                    continue
+                result.append(
+                    (body.get("agent"), body.get("user"),
+                     message.get("timestamp")))
+            if page >= data.get("pages", 0):
+                break
+            page += 1
+        return result
+
+    key = "{0}-{1}".format(groupname, since.isoformat())
+    return cache.cached("datagrepper-sponsorships", key, fetch)
 
 
 def get_sponsors_usernames_mock():
     return ["frostyx", "msuchy", "praiskup", "schlupov"]
 
 
+def personal_config_url(username):
+    # This is the same as https://<username>.fedorapeople.org/sponsor.yaml but
+    # all requests go to the same host, so they can share connections
+    return "https://fedorapeople.org/~{0}/sponsor.yaml".format(username)
+
+
+def get_session():
+    """
+    Sessions are not thread-safe, so every thread has its own one, with its
+    own pool of connections
+    """
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def revalidate_personal_config(username):
+    """
+    Download a personal config from fedorapeople.org. If we downloaded it
+    before, ask only whether it changed since then. Return a tuple of the
+    config and a status, one of `unchanged`, `updated`, `missing`, `error`.
+    On an error, the previously downloaded config is returned, if there is
+    any, so that a temporary outage doesn't drop the sponsor from groups.
+    """
+    stored = cache.get("fedorapeople-validators", username)
+    headers = {}
+    previous = None
+    if stored is not MISSING and stored:
+        previous = stored["config"]
+        if stored.get("etag"):
+            headers["If-None-Match"] = stored["etag"]
+        if stored.get("last_modified"):
+            headers["If-Modified-Since"] = stored["last_modified"]
+
+    def get():
+        response = get_session().get(personal_config_url(username),
+                                     headers=headers, timeout=FETCH_TIMEOUT)
+        # Let server errors be retried
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+    try:
+        response = resilience.call("fedorapeople", get)
+    except (resilience.Unavailable, requests.RequestException):
+        return previous, "error"
+
+    if response.status_code == 304 and headers:
+        config, status = stored["config"], "unchanged"
+
+    # Most sponsors don't have any config, remember that. Other errors are
+    # most likely temporary, so let's not cache them.
+    elif response.status_code == 404:
+        config, status = None, "missing"
+        cache.set("fedorapeople-validators", username, None)
+
+    elif response.status_code == 200:
+        try:
+            config = yaml.safe_load(response.text)
+        except yaml.YAMLError:
+            return previous, "error"
+        status = "updated"
+        cache.set("fedorapeople-validators", username, {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "config": config,
+        })
+
+    else:
+        return previous, "error"
+
+    cache.set("fedorapeople", username, config)
+    return config, status
+
+
 def fetch_personal_config(username):
-    url = "https://{0}.fedorapeople.org/sponsor.yaml".format(username)
-    response = requests.get(url)
-    if response.status_code != 200:
-        return None
-    return yaml.safe_load(response.text)
+    if username in PERSONAL_CONFIGS:
+        return PERSONAL_CONFIGS[username]
+    config = cache.get("fedorapeople", username)
+    if config is MISSING:
+        config, _ = revalidate_personal_config(username)
+    PERSONAL_CONFIGS[username] = config
+    return config
 
 
-def fetch_personal_configs():
-    usernames = ["frostyx"]
-    return [fetch_personal_config(username) for username in usernames]
+def fetch_personal_configs(usernames, workers=FETCH_WORKERS):
+    """
+    Download personal configs of all users in parallel. Return a dict of
+    configs and a dict of statuses (see `revalidate_personal_config`), both
+    indexed by usernames. Configs that are still fresh in the cache are not
+    downloaded at all, their status is `cached`.
+    """
+    configs, statuses = {}, {}
+    expired = []
+    for username in usernames:
+        config = cache.get("fedorapeople", username)
+        if config is MISSING:
+            expired.append(username)
+        else:
+            configs[username], statuses[username] = config, "cached"
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(revalidate_personal_config, expired)
+        for username, (config, status) in zip(expired, results):
+            configs[username], statuses[username] = config, status
+    PERSONAL_CONFIGS.update(configs)
+    return configs, statuses
 
 
 def load_upstream_config(path):
@@ -50,15 +328,21 @@ def dump_build_file(filename, content):
         f.write(content)
 
 
-def main():
+def build_groups(usernames, configs=None, statuses=None):
+    """
+    Merge the upstream configs with personal configs of all `usernames`,
+    dump the results into the `_build` directory and return them. The
+    personal configs are downloaded unless they are passed.
+    """
     interests = load_upstream_config("interests.yaml")
     languages = load_upstream_config("languages.yaml")
-    configs = fetch_personal_configs()
 
-    # usernames = get_sponsors_usernames_mock()
-    usernames = get_sponsors_usernames()
+    if configs is None:
+        configs, statuses = fetch_personal_configs(usernames)
     for username in usernames:
-        config = fetch_personal_config(username)
+        if statuses[username] == "error":
+            print("Unable to fetch config for {0}".format(username))
+        config = configs[username]
         if not config:
             continue
 
@@ -69,6 +353,24 @@ def main():
     dump_build_file("interests.yaml", yaml.dump(interests))
     dump_build_file("languages.yaml", yaml.dump(languages))
 
+    summary = {}
+    for status in statuses.values():
+        summary[status] = summary.get(status, 0) + 1
+    print("Personal configs: {0}".format(", ".join(
+        "{0} {1}".format(count, status)
+        for status, count in sorted(summary.items()))))
+    return interests, languages
+
+
+def main():
+    transport.install_from_environment()
+    metrics.install()
+    with stats.stage("groups"):
+        # usernames = get_sponsors_usernames_mock()
+        usernames = get_sponsors_usernames()
+        build_groups(usernames)
+    stats.dump("groups")
+
 
 if __name__ == "__main__":
     main()
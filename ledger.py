@@ -0,0 +1,119 @@
+"""
+Persistent ledger of sponsor activity evidence
+
+Every time `activity.py` finds a proof that a sponsor was active (a bug and
+a rule it matched, or their sponsor.yaml), it is recorded into a SQLite
+database in `_build/activity-ledger.sqlite`. Unlike `active-sponsors.list`,
+the ledger remembers why and when somebody was active, and it can be
+queried without going back to Bugzilla.
+"""
+
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+
+# One recorded piece of evidence. The `bug_id` is `None` for evidence that
+# doesn't come from Bugzilla, e.g. sponsor.yaml
+Record = namedtuple("Record", ["sponsor", "rule", "bug_id", "date"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS evidence (
+    sponsor TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    bug_id INTEGER,
+    date TEXT NOT NULL,
+    recorded TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS evidence_unique
+    ON evidence (sponsor, rule, IFNULL(bug_id, 0), date);
+CREATE INDEX IF NOT EXISTS evidence_sponsor_date ON evidence (sponsor, date);
+CREATE INDEX IF NOT EXISTS evidence_date ON evidence (date);
+"""
+
+
+def default_path():
+    here = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(here, "_build", "activity-ledger.sqlite")
+
+
+class Ledger:
+    """
+    Sponsors are processed in parallel, so one connection is shared by all
+    threads and guarded by a lock
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+        # Records added during this run, see `activity.merge_shards`
+        self.recorded = []
+
+    def record(self, sponsor, rule, bug_id, when):
+        """
+        Remember that `sponsor` was active on the `when` date. Recording the
+        same evidence multiple times is fine.
+        """
+        query = ("INSERT OR IGNORE INTO evidence "
+                 "(sponsor, rule, bug_id, date, recorded) "
+                 "VALUES (?, ?, ?, ?, ?)")
+        values = (sponsor, rule, bug_id, when.isoformat(),
+                  datetime.now().isoformat())
+        with self._lock, self.connection:
+            self.connection.execute(query, values)
+            self.recorded.append(Record(sponsor, rule, bug_id, when))
+
+    def evidence(self, sponsor):
+        """
+        All the recorded evidence of a sponsor, the most recent first
+        """
+        query = ("SELECT sponsor, rule, bug_id, date FROM evidence "
+                 "WHERE sponsor = ? ORDER BY date DESC")
+        with self._lock:
+            rows = self.connection.execute(query, (sponsor,)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def last_activity(self, sponsor=None):
+        """
+        Date of the most recent evidence of a sponsor, or `None`. Without a
+        sponsor, return a dict mapping all known sponsors to their dates.
+        """
+        if sponsor:
+            query = "SELECT MAX(date) FROM evidence WHERE sponsor = ?"
+            with self._lock:
+                row = self.connection.execute(query, (sponsor,)).fetchone()
+            return date.fromisoformat(row[0]) if row[0] else None
+
+        query = "SELECT sponsor, MAX(date) FROM evidence GROUP BY sponsor"
+        with self._lock:
+            rows = self.connection.execute(query).fetchall()
+        return {sponsor: date.fromisoformat(when) for sponsor, when in rows}
+
+    def expiring(self, days_ago, margin, today=None):
+        """
+        Sponsors whose most recent evidence is still within the `days_ago`
+        window, but is going to fall out of it within `margin` days. Returns
+        a list of `(sponsor, last_activity)` tuples, the oldest first.
+        """
+        today = today or date.today()
+        cutoff = today - timedelta(days_ago)
+        query = ("SELECT sponsor, MAX(date) AS last FROM evidence "
+                 "GROUP BY sponsor HAVING last > ? AND last <= ? "
+                 "ORDER BY last")
+        values = (cutoff.isoformat(), (cutoff + timedelta(margin)).isoformat())
+        with self._lock:
+            rows = self.connection.execute(query, values).fetchall()
+        return [(sponsor, date.fromisoformat(when)) for sponsor, when in rows]
+
+    def close(self):
+        self.connection.close()
+
+    def _record(self, row):
+        sponsor, rule, bug_id, when = row
+        return Record(sponsor, rule, bug_id, date.fromisoformat(when))
@@ -0,0 +1,182 @@
+"""
+Find out where the time goes
+
+Records wall time of pipeline stages and of every sponsor, and for each
+remote backend the number of requests, their latency histogram, errors,
+retries and transferred bytes. Everything is written to
+`_build/metrics.json`, one section for each entry point.
+
+Set `FEDORA_SPONSORS_PROFILE=<stage>` (or use `--profile` where available)
+to capture cProfile data of a stage into `_build/profile-<stage>.prof`.
+Only the thread running the stage is profiled.
+"""
+
+import os
+import json
+import time
+import cProfile
+import threading
+import contextlib
+from urllib.parse import urlparse
+import requests
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")]
+
+_original_send = None
+
+
+def backend_for_url(url):
+    host = urlparse(url).hostname or ""
+    if host.endswith("fedorapeople.org"):
+        return "fedorapeople"
+    if host == "fasjson.fedoraproject.org":
+        return "fas"
+    if host == "bugzilla.redhat.com":
+        return "bugzilla"
+    if host == "apps.fedoraproject.org":
+        return "datagrepper"
+    return host
+
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.sponsors = {}
+        self.backends = {}
+        self.profile_stage = os.environ.get("FEDORA_SPONSORS_PROFILE")
+        self._lock = threading.Lock()
+
+    def _backend(self, name):
+        if name not in self.backends:
+            self.backends[name] = {
+                "requests": 0,
+                "errors": 0,
+                "retries": 0,
+                "give_ups": 0,
+                "bytes": 0,
+                "seconds": 0,
+                "latency": [0] * len(LATENCY_BUCKETS),
+            }
+        return self.backends[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure wall time of a pipeline stage. Stages may be nested and the
+        same stage may run multiple times.
+        """
+        profiler = None
+        if name == self.profile_stage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {"runs": 0, "seconds": 0})
+                stage["runs"] += 1
+                stage["seconds"] += elapsed
+
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(
+                    builddir(), "profile-{0}.prof".format(name)))
+
+    @contextlib.contextmanager
+    def sponsor(self, username):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.sponsors[username] = time.perf_counter() - start
+
+    def request(self, backend, seconds, size, error=False):
+        with self._lock:
+            stats = self._backend(backend)
+            stats["requests"] += 1
+            stats["seconds"] += seconds
+            stats["bytes"] += size
+            if error:
+                stats["errors"] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["latency"][i] += 1
+                    break
+
+    def retry(self, backend):
+        with self._lock:
+            self._backend(backend)["retries"] += 1
+
+    def give_up(self, backend):
+        with self._lock:
+            self._backend(backend)["give_ups"] += 1
+
+    def as_dict(self):
+        with self._lock:
+            slowest = sorted(self.sponsors.items(), key=lambda x: x[1],
+                             reverse=True)
+            return {
+                "stages": dict(self.stages),
+                "sponsors": dict(slowest),
+                "backends": dict(self.backends),
+                "latency_buckets": [str(x) for x in LATENCY_BUCKETS],
+            }
+
+    def dump(self, name):
+        """
+        Store the metrics of an entry point into `_build/metrics.json`,
+        keeping the other entry points there
+        """
+        path = os.path.join(builddir(), "metrics.json")
+        try:
+            with open(path, "r") as f:
+                content = json.load(f)
+        except (FileNotFoundError, ValueError):
+            content = {}
+
+        content[name] = self.as_dict()
+        content[name]["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(content, f, indent=2)
+
+
+def builddir():
+    here = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(here, "_build")
+
+
+def install():
+    """
+    Measure every HTTP request made through `requests`. Call this after
+    `transport.install_from_environment`, so that replayed requests are
+    measured too.
+    """
+    global _original_send
+    if _original_send:
+        return
+    _original_send = requests.Session.send
+
+    def send(session, request, **kwargs):
+        backend = backend_for_url(request.url)
+        start = time.perf_counter()
+        try:
+            response = _original_send(session, request, **kwargs)
+        except Exception:
+            metrics.request(backend, time.perf_counter() - start, 0, True)
+            raise
+        size = len(response.content or b"")
+        metrics.request(backend, time.perf_counter() - start, size,
+                        response.status_code >= 500)
+        return response
+
+    requests.Session.send = send
+
+
+metrics = Metrics()
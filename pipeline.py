@@ -0,0 +1,199 @@
+"""
+Run the whole pipeline (activity, groups, build) in a single process
+
+Stages share one snapshot of the sponsor roster and one set of clients, so
+nothing is initialized or downloaded twice. Stages that don't depend on each
+other run concurrently, e.g. personal configs are downloaded while the review
+bugs and their histories are fetched from Bugzilla. The intermediate files in
+the `_build` directory are still written, so `make build` etc. can be run
+separately afterwards.
+"""
+
+import sys
+import argparse
+import xmlrpc.client
+import bugzilla
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fasjson_client import Client
+from fasjson_client.errors import APIError
+
+import activity
+import groups
+import sponsors
+import transport
+import metrics
+import resilience
+from metrics import metrics as stats
+
+
+class Snapshot:
+    """
+    Everything that the stages share. Stages store their results here too.
+    """
+
+    def __init__(self, client, bz):
+        self.client = client
+        self.bz = bz
+        self.usernames = groups.get_sponsors_usernames(client)
+        self.users = groups.get_fas_users(client, self.usernames)
+        self.sponsors = {username: activity.User(username, client, bz)
+                         for username in self.usernames}
+        self.configs = None
+        self.statuses = None
+        self.state = None
+        self.index = None
+        self.histories = activity.BugHistories(bz)
+        self.active = None
+        self.interests = None
+        self.languages = None
+
+
+def run_sponsorships(snapshot, args):
+    activity.find_directly_sponsored()
+
+
+def run_configs(snapshot, args):
+    # Both activity and groups need the personal configs, download them once
+    snapshot.configs, snapshot.statuses = \
+        groups.fetch_personal_configs(
+            snapshot.usernames,
+            workers=activity.backend_limit("fedorapeople"))
+
+
+def run_index(snapshot, args):
+    snapshot.state = {} if args.full else activity.load_state()
+    # Personal configs are being downloaded at the same time, sponsors that
+    # turn out to need older bugs query Bugzilla on their own. Without any
+    # state, the index covers the whole window for everybody.
+    candidates = activity.bugzilla_candidates(snapshot.sponsors,
+                                              snapshot.state)
+    snapshot.index = activity.build_index(snapshot.bz, snapshot.state,
+                                          candidates)
+
+
+def run_histories(snapshot, args):
+    if not snapshot.index:
+        return
+    candidates = activity.bugzilla_candidates(snapshot.sponsors,
+                                              snapshot.state)
+    try:
+        activity.prefetch_histories(candidates, snapshot.sponsors,
+                                    snapshot.histories, snapshot.index,
+                                    snapshot.state)
+    # Not a big deal, histories will be fetched one by one later
+    except (resilience.Unavailable, xmlrpc.client.Error, APIError) as ex:
+        print("Unable to prefetch bug histories: {0}".format(ex))
+
+
+def run_activity(snapshot, args):
+    snapshot.active = activity.examine_sponsors(
+        snapshot.usernames, snapshot.sponsors, snapshot.client, snapshot.bz,
+        snapshot.state, snapshot.index, histories=snapshot.histories,
+        workers=args.workers, configs=snapshot.configs)
+
+
+def run_groups(snapshot, args):
+    snapshot.interests, snapshot.languages = \
+        groups.build_groups(snapshot.usernames, snapshot.configs,
+                            snapshot.statuses)
+
+
+def run_build(snapshot, args):
+    sponsors.build_site(
+        sponsors.roster_sponsors(snapshot.usernames, snapshot.users),
+        active_usernames=snapshot.active,
+        interests=snapshot.interests,
+        languages=snapshot.languages,
+    )
+
+
+# Every stage has a list of stages it depends on and a function to run it
+STAGES = {
+    "sponsorships": ([], run_sponsorships),
+    "configs": ([], run_configs),
+    "index": ([], run_index),
+    "histories": (["index", "sponsorships"], run_histories),
+    "activity": (["sponsorships", "configs", "index", "histories"],
+                 run_activity),
+    "groups": (["configs"], run_groups),
+    "build": (["activity", "groups"], run_build),
+}
+
+
+def run_stage(name, function, snapshot, args):
+    with stats.stage(name):
+        function(snapshot, args)
+
+
+def run_stages(stages, snapshot, args):
+    """
+    Run every stage as soon as all its dependencies are finished
+    """
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while len(done) < len(stages):
+            for name, (requires, function) in stages.items():
+                if name in done or name in running.values():
+                    continue
+                if not set(requires) <= done:
+                    continue
+                print("Starting stage {0}".format(name))
+                running[executor.submit(run_stage, name, function, snapshot,
+                                        args)] = name
+
+            if not running:
+                raise ValueError("Some stages can never be started: {0}"
+                                 .format(set(stages) - done))
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                # Re-raise exceptions from the stage
+                future.result()
+                print("Finished stage {0}".format(name))
+                done.add(name)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run the whole pipeline in a single process")
+    parser.add_argument(
+        "--workers", type=int, default=8,
+        help="How many sponsors should be processed in parallel")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Ignore the state from the previous activity run")
+    parser.add_argument(
+        "--profile", metavar="STAGE",
+        help="Capture cProfile data of a stage, e.g. build")
+    return parser.parse_args()
+
+
+def main():
+    transport.install_from_environment()
+    metrics.install()
+    args = parse_args()
+    if args.profile:
+        stats.profile_stage = args.profile
+
+    with stats.stage("pipeline"):
+        client = Client("https://fasjson.fedoraproject.org")
+        try:
+            bz = resilience.call("bugzilla", bugzilla.Bugzilla,
+                                 url="https://bugzilla.redhat.com/xmlrpc.cgi")
+        except resilience.Unavailable as ex:
+            print("Unable to connect to Bugzilla, try again. {0}".format(ex))
+            sys.exit(1)
+        with stats.stage("snapshot"):
+            snapshot = Snapshot(client, bz)
+        try:
+            run_stages(STAGES, snapshot, args)
+        except resilience.Unavailable as ex:
+            print("Unable to build the site, try again. {0}".format(ex))
+            sys.exit(1)
+    stats.dump("pipeline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Retries, rate limiting and circuit breaking for all remote calls
+
+Every request to FAS, Bugzilla, or fedorapeople.org should go through
+`call`. Temporary failures are retried with exponential backoff and jitter,
+so that parallel workers don't hammer an overloaded server in lock-step.
+Once a backend runs out of its retry budget or keeps failing, we give up and
+raise `Unavailable` instead of waiting forever.
+"""
+
+import time
+import random
+import threading
+import xmlrpc.client
+import requests
+
+from metrics import metrics
+
+
+class Unavailable(Exception):
+    """
+    A backend couldn't be reached and we gave up
+    """
+
+
+class TokenBucket:
+    """
+    Allow at most `rate` calls per second, with bursts of up to `burst` calls
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    After `threshold` consecutive failures, refuse all calls for
+    `reset_after` seconds. Then let one call through to find out whether the
+    backend recovered.
+    """
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.reset_after:
+                return False
+            # Half-open, the next failure opens the circuit again
+            self.opened = None
+            self.failures = self.threshold - 1
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+
+class RetryBudget:
+    """
+    How many retries we are willing to make during the whole run
+    """
+
+    def __init__(self, retries):
+        self.retries = retries
+        self._lock = threading.Lock()
+
+    def spend(self):
+        with self._lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+            return True
+
+
+def is_retryable(ex):
+    """
+    Is this error most likely temporary?
+    """
+    if isinstance(ex, (requests.RequestException, xmlrpc.client.ProtocolError,
+                       ConnectionError, TimeoutError)):
+        return True
+
+    # E.g. `fasjson_client.errors.APIError`, only server errors are temporary
+    code = getattr(ex, "code", None)
+    return isinstance(code, int) and (code == 429 or code >= 500)
+
+
+class Backend:
+    """
+    Resilience policy for one remote backend
+    """
+
+    def __init__(self, name, rate, burst, retries, max_attempts=5,
+                 base_delay=1, max_delay=60, threshold=10, reset_after=60):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.budget = RetryBudget(retries)
+        self.breaker = CircuitBreaker(threshold, reset_after)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        # Exponential backoff with full jitter
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, cap)
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.give_up(self.name)
+                raise Unavailable("{0} is failing, giving up".format(self.name))
+
+            self.bucket.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as ex:
+                if not is_retryable(ex):
+                    raise
+                self.breaker.failure()
+                attempt += 1
+                if attempt >= self.max_attempts or not self.budget.spend():
+                    metrics.give_up(self.name)
+                    raise Unavailable("{0}: {1}".format(self.name, ex)) from ex
+                metrics.retry(self.name)
+                time.sleep(self.delay(attempt))
+                continue
+
+            self.breaker.success()
+            return result
+
+
+BACKENDS = {
+    "fas": Backend("fas", rate=10, burst=20, retries=200),
+    "bugzilla": Backend("bugzilla", rate=5, burst=10, retries=200),
+    "fedorapeople": Backend("fedorapeople", rate=20, burst=40, retries=200),
+    "datagrepper": Backend("datagrepper", rate=2, burst=4, retries=50),
+}
+
+
+def call(backend, function, *args, **kwargs):
+    """
+    Call `function` which talks to a given `backend` (see `BACKENDS`)
+    """
+    return BACKENDS[backend].call(function, *args, **kwargs)
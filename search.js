@@ -0,0 +1,63 @@
+// Search sponsors in the index generated by `RenderEngine.search_index`.
+// Every word of the query must be a prefix of some token of a sponsor.
+
+(function () {
+  var input = document.getElementById("search-query");
+  var results = document.getElementById("search-results");
+  var index = null;
+
+  function lookup(word) {
+    var found = new Set();
+    Object.keys(index.tokens).forEach(function (token) {
+      if (token.startsWith(word)) {
+        index.tokens[token].forEach(function (i) { found.add(i); });
+      }
+    });
+    return found;
+  }
+
+  function show(positions) {
+    results.textContent = "";
+    positions.forEach(function (i) {
+      var sponsor = index.sponsors[i];
+      var link = document.createElement("a");
+      link.href = input.dataset.all + "#" + sponsor[0];
+      link.textContent = sponsor[1] + " (" + sponsor[0] + ")";
+
+      var item = document.createElement("li");
+      if (!sponsor[2]) {
+        item.className = "text-muted";
+      }
+      item.appendChild(link);
+      results.appendChild(item);
+    });
+  }
+
+  function search() {
+    if (!index) {
+      return;
+    }
+    var words = input.value.toLowerCase().split(/\s+/).filter(Boolean);
+    if (!words.length) {
+      show([]);
+      return;
+    }
+
+    var matches = null;
+    words.forEach(function (word) {
+      var found = lookup(word);
+      matches = matches === null ? found : new Set(
+        Array.from(matches).filter(function (i) { return found.has(i); }));
+    });
+    show(Array.from(matches).sort(function (a, b) { return a - b; }));
+  }
+
+  fetch(input.dataset.index)
+    .then(function (response) { return response.json(); })
+    .then(function (data) {
+      index = data;
+      search();
+    });
+
+  input.addEventListener("input", search);
+})();
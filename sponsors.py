@@ -1,20 +1,68 @@
 import os
 import sys
-import time
-import shutil
 import yaml
 import html
-import pytz
 import munch
 import json
 import bugzilla
 import xmlrpc
-from datetime import datetime
+import hashlib
+import re
+import gzip
+from datetime import datetime, timezone
 from requests import ConnectionError
 from jinja2 import Template
 from fasjson_client import Client
 from jinja2 import Environment, FileSystemLoader
+from markupsafe import Markup
+from functools import lru_cache, cached_property
 from libravatar import libravatar_url
+from groups import get_sponsors_usernames, get_fas_user, get_fas_users
+from cache import cache, MISSING
+import resilience
+import transport
+import metrics
+from metrics import metrics as stats
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+except ImportError:
+    import pytz
+    ZoneInfo = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Title of the timezone group for sponsors with an invalid timezone
+UNKNOWN_TIMEZONE = "Unknown"
+
+# Mapping of Bugzilla emails to Bugzilla user IDs, see
+# `resolve_bugzilla_user_ids`
+BUGZILLA_USER_IDS = {}
+
+# Parts of the pages that change with every build (see the footer in
+# `layout.html.j2`). They are ignored when deciding whether a page changed,
+# otherwise every page would be rewritten every time.
+BUILD_STAMP = re.compile(
+    r"<!-- Timestamp: [^>]* -->|<span>Last build: [^<]*</span>")
+
+# Whitespace inside of these elements matters, don't minify it
+PRESERVED_HTML = re.compile(
+    r"<(pre|textarea|script|style)\b.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+
+WHITESPACE = re.compile(r"\s+")
+
+# Words that are searchable, see `RenderEngine.search_index`
+SEARCH_TOKEN = re.compile(r"\w+")
+
+# Files that get precompressed `.gz` and `.br` variants next to them
+COMPRESSED_EXTENSIONS = (".html", ".json", ".ndjson", ".list", ".yaml")
+
+# Compressing tiny files isn't worth it
+MIN_COMPRESS_SIZE = 1024
 
 
 class Sponsor(munch.Munch):
@@ -59,6 +107,10 @@ class Sponsor(munch.Munch):
     def is_active(self):
         return getattr(self, "active", False)
 
+    @property
+    def bugzilla_email(self):
+        return (self.rhbzemail or self.emails[0]).lower()
+
     @property
     def bugzilla_user_id(self):
         """
@@ -66,14 +118,69 @@ class Sponsor(munch.Munch):
         a packager sponsor. Alternativelly it could use email but we don't want
         to publish it.
         """
-        bz = bugzilla.Bugzilla(url="https://bugzilla.redhat.com")
-        email = self.rhbzemail or self.emails[0]
+        if self.bugzilla_email not in BUGZILLA_USER_IDS:
+            resolve_bugzilla_user_ids([self])
+        return BUGZILLA_USER_IDS[self.bugzilla_email]
+
+
+@lru_cache(maxsize=None)
+def get_bugzilla_client():
+    # Connecting already talks to Bugzilla
+    return resilience.call(
+        "bugzilla", bugzilla.Bugzilla, url="https://bugzilla.redhat.com")
+
+
+def resolve_bugzilla_user_ids(sponsors, chunk_size=100):
+    """
+    Find Bugzilla user IDs for all `sponsors` and store them in
+    `BUGZILLA_USER_IDS`. IDs don't change, so they are cached and only
+    the unknown ones are queried, many users in one `getusers` call.
+    """
+    missing = []
+    for email in {sponsor.bugzilla_email for sponsor in sponsors}:
+        userid = cache.get("bugzilla-user", email)
+        if userid is MISSING:
+            missing.append(email)
+        else:
+            BUGZILLA_USER_IDS[email] = userid
+
+    if not missing:
+        return
+
+    try:
+        bz = get_bugzilla_client()
+    except resilience.Unavailable as ex:
+        # The IDs stay unknown for this build but they are not remembered
+        print("Unable to resolve Bugzilla user IDs: {0}".format(ex))
+        for email in missing:
+            BUGZILLA_USER_IDS[email] = None
+        return
+
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        unavailable = set()
         try:
-            rhbzuser = bz.getuser(email)
-            return rhbzuser.userid
-        # This happens for ~3 users
-        except xmlrpc.client.Error:
-            return None
+            users = resilience.call("bugzilla", bz.getusers, chunk)
+        # A single unknown email fails the whole call. This happens for ~3
+        # users, so let's query them one by one
+        except (xmlrpc.client.Error, resilience.Unavailable):
+            users = []
+            for email in chunk:
+                try:
+                    users.append(resilience.call("bugzilla", bz.getuser, email))
+                except xmlrpc.client.Error:
+                    pass
+                except resilience.Unavailable:
+                    unavailable.add(email)
+
+        found = {user.email.lower(): user.userid for user in users}
+        for email in chunk:
+            userid = found.get(email)
+            BUGZILLA_USER_IDS[email] = userid
+            # Don't remember that an user doesn't exist when we simply
+            # couldn't ask
+            if email not in unavailable:
+                cache.set("bugzilla-user", email, userid)
 
 
 def get_fas_client():
@@ -82,34 +189,85 @@ def get_fas_client():
 
 def get_sponsors():
     client = get_fas_client()
-    usernames = client.list_group_sponsors(groupname="packager").result
-    return [Sponsor(client.get_user(username=sponsor["username"]).result)
-            for sponsor in usernames]
+    usernames = get_sponsors_usernames(client)
+    users = get_fas_users(client, usernames)
+    return roster_sponsors(usernames, users)
+
+
+def roster_sponsors(usernames, users):
+    """
+    Return a `Sponsor` for every username in the roster. The Fedora Review
+    Service decides who is a sponsor based on our API, so we must not publish
+    it with somebody missing. Raise `resilience.Unavailable` if any of the
+    `users` couldn't be fetched from FAS.
+    """
+    missing = [username for username in usernames if username not in users]
+    if missing:
+        raise resilience.Unavailable("Unable to get {0} from FAS".format(
+            ", ".join(missing)))
+    return [Sponsor(users[username]) for username in usernames]
 
 
 def get_sponsors_mock():
     client = get_fas_client()
     usernames = ["frostyx", "msuchy", "praiskup", "schlupov"]
-    return [Sponsor(client.get_user(username=x).result)
-            for x in usernames]
+    return [Sponsor(get_fas_user(client, x)) for x in usernames]
 
 
-def sponsor_by_username(username, sponsors):
-    for sponsor in sponsors:
-        if sponsor.username == username:
-            return sponsor
-    return None
+class SponsorRegistry:
+    """
+    All sponsors indexed by their username. The list of active sponsors is
+    loaded only once and sponsors are always kept in a predictable order.
+    """
+
+    def __init__(self, sponsors, active_usernames=None):
+        if active_usernames is None:
+            active_usernames = load_active_usernames()
+
+        # Sort sponsors alphabetically by their username so that they are
+        # always in a predictable order
+        self.sponsors = sorted(sponsors, key=lambda x: x.username)
+        self.by_username = {x.username: x for x in self.sponsors}
+        self.position = {x.username: i for i, x in enumerate(self.sponsors)}
+
+        for username in active_usernames:
+            if username in self.by_username:
+                self.by_username[username].update({"active": True})
+
+    def __iter__(self):
+        return iter(self.sponsors)
+
+    def __len__(self):
+        return len(self.sponsors)
+
+    def get(self, username):
+        return self.by_username.get(username)
+
+    def group(self, usernames):
+        """
+        Known sponsors with the given usernames, in the registry order
+        """
+        known = {u for u in usernames if u in self.by_username}
+        return [self.by_username[u]
+                for u in sorted(known, key=self.position.get)]
+
+    def active(self):
+        return [sponsor for sponsor in self.sponsors if sponsor.is_active]
 
 
-def sponsors_by_areas_of_interest(sponsors):
-    return sponsors_from_yaml("_build/interests.yaml", sponsors)
+def sponsors_by_areas_of_interest(registry, content=None):
+    if content is not None:
+        return sponsors_from_config(content, registry)
+    return sponsors_from_yaml("_build/interests.yaml", registry)
 
 
-def sponsors_by_native_language(sponsors):
-    return sponsors_from_yaml("_build/languages.yaml", sponsors)
+def sponsors_by_native_language(registry, content=None):
+    if content is not None:
+        return sponsors_from_config(content, registry)
+    return sponsors_from_yaml("_build/languages.yaml", registry)
 
 
-def sponsors_from_yaml(path, sponsors):
+def sponsors_from_yaml(path, registry):
     content = []
 
     try:
@@ -118,109 +276,148 @@ def sponsors_from_yaml(path, sponsors):
     except FileNotFoundError:
         print("Missing {0} file, you should probably run `make groups'"
               .format(path))
+    return sponsors_from_config(content, registry)
 
+
+def sponsors_from_config(content, registry):
+    """
+    Turn a list of groups (in the `interests.yaml` format) to a dict mapping
+    group titles to lists of sponsors
+    """
     result = {}
     for item in content:
-        usernames = item.get("users", [])
-        interested = [sponsor_by_username(u, sponsors) for u in usernames]
-        interested = list(filter(None, interested))
+        interested = registry.group(item.get("users", []))
         if not interested:
             continue
         title = item.get("title", item["id"].capitalize())
         result[title] = interested
+    return result
 
-    for _, group in result.items():
-        set_sponsors_activity(group)
-        # Sort sponsors alphabetically by their username so that they are
-        # always in a predictable order
-        group.sort(key=lambda x: x.username)
+
+@lru_cache(maxsize=None)
+def canonical_timezones():
+    """
+    Map lowercase timezone names to their canonical spelling
+    """
+    names = available_timezones() if ZoneInfo else pytz.all_timezones
+    return {name.lower(): name for name in names}
+
+
+def get_timezone(name):
+    """
+    Return a `tzinfo` for a timezone name or `None` if we don't know it
+    """
+    if ZoneInfo:
+        # Unlike pytz, zoneinfo is case-sensitive
+        name = canonical_timezones().get(name.lower(), name)
+        try:
+            return ZoneInfo(name)
+        # E.g. `IsADirectoryError` for "Europe"
+        except (ZoneInfoNotFoundError, ValueError, OSError):
+            return None
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        return None
+
+
+def utc_offsets(names, now=None):
+    """
+    Resolve each distinct timezone name to its UTC offset in seconds, all
+    from the same reference instant. Unknown timezones map to `None`.
+    """
+    now = now or datetime.now(timezone.utc)
+    result = {}
+    for name in set(names):
+        tz = get_timezone(name)
+        result[name] = now.astimezone(tz).utcoffset().total_seconds() \
+            if tz else None
     return result
 
 
+def timezone_title(seconds):
+    """
+    Human-readable title for a UTC offset, e.g. `UTC +2` or `UTC -9:30`
+    """
+    if not seconds:
+        return "UTC"
+
+    sign = "+" if seconds > 0 else "-"
+    hours, minutes = divmod(int(abs(seconds)) // 60, 60)
+
+    # If the offset is only hours, simply return its integer value
+    # Otherwise calculate also the minutes offset
+    if not minutes:
+        return "UTC {0}{1}".format(sign, hours)
+    return "UTC {0}{1}:{2:02d}".format(sign, hours, minutes)
+
+
 def sponsors_by_region(sponsors):
     # List of canonical timezones (well, their first parts) from
     # https://en.wikipedia.org/wiki/List_of_tz_database_time_zones
     regions = {"Africa", "America", "Asia", "Atlantic", "Australia", "Europe",
                "Indian", "Pacific"}
+
+    # Many sponsors share the same timezone, resolve each of them only once
+    names = {sponsor.timezone for sponsor in sponsors if sponsor.timezone}
+    canonical = canonical_timezones()
+    region_of = {name: canonical.get(name.lower(), name).split("/")[0]
+                 for name in names}
+
     result = {}
     for sponsor in sponsors:
-        if not sponsor.timezone:
-            continue
-
-        timezone = sponsor.timezone.split("/")[0]
-        if not timezone in regions:
+        region = region_of.get(sponsor.timezone)
+        if region not in regions:
             continue
 
-        result.setdefault(timezone, [])
-        result[timezone].append(sponsor)
+        result.setdefault(region, [])
+        result[region].append(sponsor)
     return result
 
 
-def sponsors_by_timezone(sponsors):
-    result = {}
-
+def sponsors_by_timezone(sponsors, now=None):
     # Let's use only numeric `seconds` values as keys so we can easily order the
     # dictinary once it is constructed
+    names = [sponsor.timezone for sponsor in sponsors if sponsor.timezone]
+    offsets = utc_offsets(names, now)
+
+    result = {}
+    unknown = []
     for sponsor in sponsors:
         if not sponsor.timezone:
             continue
 
-        # https://stackoverflow.com/a/5537943/3285282
-        timezone = pytz.timezone(sponsor.timezone)
-        timezone_now = datetime.now(timezone)
-        seconds = timezone_now.utcoffset().total_seconds()
+        seconds = offsets[sponsor.timezone]
+        if seconds is None:
+            unknown.append(sponsor)
+            continue
 
         result.setdefault(seconds, [])
         result[seconds].append(sponsor)
 
     # Transform the numeric keys to proper titles
-    titled = {}
-    for seconds, sponsors in sorted(result.items()):
-        # First, let's figure out the title format
-        if seconds > 0:
-            title = "UTC +{}"
-        elif seconds < 0:
-            title = "UTC {}"
-        else:
-            title = "UTC"
-
-        # If the offset is only hours, simply return its integer value
-        # Otherwise calculate also the minutes offset
-        hours = seconds/60/60
-        if hours == int(hours):
-            offset = int(hours)
-        else:
-            offset = time.strftime("%H:%M", time.gmtime(seconds)).lstrip("0")
-
-        title = title.format(offset)
-        titled[title] = sponsors
+    titled = {timezone_title(seconds): sponsors
+              for seconds, sponsors in sorted(result.items())}
 
+    # Don't crash the whole build because of some invalid timezone
+    if unknown:
+        titled[UNKNOWN_TIMEZONE] = unknown
     return titled
 
 
-def active_sponsors(sponsors):
-    return [sponsor for sponsor in sponsors if sponsor.is_active]
+def active_sponsors(registry):
+    return registry.active()
 
 
-def set_sponsors_activity(sponsors):
+def load_active_usernames():
     here = os.path.dirname(os.path.realpath(__file__))
     path = os.path.join(here, "_build/active-sponsors.list")
     try:
         with open(path) as f:
-            usernames = {x.strip() for x in f.readlines()}
+            return {x.strip() for x in f.readlines()}
     except FileNotFoundError:
         print("Cannot find {0} ... skipping".format(path))
-
-    active = []
-    for username in usernames:
-        for i, sponsor in enumerate(sponsors):
-            if username == sponsor.username:
-                sponsor.update({"active": True})
-                active.append(sponsors.pop(i))
-                break
-
-    for sponsor in reversed(active):
-        sponsors.insert(0, sponsor)
+        return set()
 
 
 def build_tag():
@@ -228,17 +425,16 @@ def build_tag():
     return now.strftime("%Y-%m-%d")
 
 
-class Builder:
+class RenderEngine:
+    """
+    Everything that is the same for all builders. Templates are compiled only
+    once and API artifacts are computed only once, builders then only decide
+    where to write the output and how the URLs look like.
+    """
+
     def __init__(self, data):
         self.data = data
-
-    @property
-    def builddir(self):
-        here = os.path.dirname(os.path.realpath(__file__))
-        return os.path.join(here, "_build")
-
-    def dump_html(self, name, content):
-        raise NotImplemented
+        self.jinja_env = Environment(loader=FileSystemLoader("templates"))
 
     @property
     def templates(self):
@@ -250,6 +446,7 @@ class Builder:
             "languages.html.j2",
             "regions.html.j2",
             "timezones.html.j2",
+            "search.html.j2",
         ]
 
     @property
@@ -261,36 +458,38 @@ class Builder:
             "languages.yaml",
         ]
 
-    @property
-    def options(self):
-        return {}
-
-    def build(self):
-        self.build_pages()
-        self.build_api()
-
-    def build_pages(self):
-        for name in self.templates:
-            builddir = self.builddir_rel_path(name)
-            rendered = self.render_template(
-                name,
-                options=self.options,
-                builddir_rel_path=builddir,
-                **self.data
-            )
-            self.dump_html(name, rendered)
-
-    def build_api(self):
-        dstdir = os.path.join(self.builddir, "api")
-        if not os.path.exists(dstdir):
-            os.makedirs(dstdir)
-        for name in self.api:
-            src = os.path.join("_build", name)
-            dst = os.path.join(dstdir, name)
-            shutil.copy2(src, dst)
-        self._build_sponsors_json(dstdir)
+    def render_template(self, name, **kwargs):
+        # The environment caches compiled templates
+        template = self.jinja_env.get_template(name)
+        return template.render(**kwargs)
 
-    def _build_sponsors_json(self, dstdir):
+    @cached_property
+    def cards(self):
+        """
+        HTML of every sponsor card, rendered only once and then reused by all
+        pages and builders. A card changes only when the sponsor data or the
+        template changes, so they are cached between runs too.
+        """
+        template = self.jinja_env.get_template("helpers.html.j2")
+        source, _, _ = self.jinja_env.loader.get_source(
+            self.jinja_env, "helpers.html.j2")
+        sponsor_card = template.module.sponsor_card
+
+        cards = {}
+        for sponsor in self.data["sponsors"]:
+            payload = json.dumps([source, sponsor, sponsor.is_active],
+                                 sort_keys=True, default=str)
+            key = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+            html = cache.cached(
+                "sponsor-card", key, lambda: str(sponsor_card(sponsor)))
+            cards[sponsor.username] = Markup(html)
+        return cards
+
+    @cached_property
+    def sponsors_api(self):
+        """
+        Public information about every sponsor, in the format of the API
+        """
         schema = [
             "username",
             "is_active",
@@ -308,25 +507,347 @@ class Builder:
             print("[{0}/{1}] {2}".format(i, len(sponsors), sponsor.username))
             subset = {k: getattr(sponsor, k) for k in schema}
             result.append(subset)
+        return result
 
+    @cached_property
+    def sponsors_json(self):
+        return json.dumps(self.sponsors_api)
+
+    @cached_property
+    def sponsors_ndjson(self):
+        """
+        The same as `sponsors_json` but one sponsor per line, so that clients
+        can process it as a stream
+        """
+        return "".join(json.dumps(x) + "\n" for x in self.sponsors_api)
+
+    @cached_property
+    def sponsor_documents(self):
+        """
+        One small JSON document for each sponsor, so that clients interested
+        in one sponsor don't need to download all of them
+        """
+        return {x["username"]: json.dumps(x) for x in self.sponsors_api}
+
+    @cached_property
+    def sponsor_indexes(self):
+        """
+        Map usernames and Bugzilla user IDs to paths of the sponsor documents,
+        relative to the API directory
+        """
+        usernames = {}
+        bugzilla_user_ids = {}
+        for sponsor in self.sponsors_api:
+            path = "sponsors/{0}.json".format(sponsor["username"])
+            usernames[sponsor["username"]] = path
+            if sponsor["bugzilla_user_id"] is not None:
+                bugzilla_user_ids[str(sponsor["bugzilla_user_id"])] = path
+        return {
+            "usernames.json": json.dumps(usernames, sort_keys=True),
+            "bugzilla-user-ids.json": json.dumps(bugzilla_user_ids,
+                                                 sort_keys=True),
+        }
+
+    @cached_property
+    def search_index(self):
+        """
+        Inverted index for the search page, mapping lowercase tokens to
+        positions in the list of sponsors. Each sponsor is stored only as
+        `[username, human_name, is_active]`, the rest is in the tokens.
+        """
+        sponsors = self.data["sponsors"]
+        position = {sponsor.username: i for i, sponsor in enumerate(sponsors)}
+        tokens = {}
+
+        def add(text, sponsor, whole=False):
+            text = html.unescape(text)
+            words = {x.lower() for x in SEARCH_TOKEN.findall(text)}
+            if whole:
+                # Queries are split on whitespace, so the phrase can't have any
+                words.add("".join(text.lower().split()))
+            for word in words:
+                tokens.setdefault(word, set()).add(position[sponsor.username])
+
+        for sponsor in sponsors:
+            add(sponsor.username, sponsor, whole=True)
+            add(sponsor.human_name, sponsor)
+            add(sponsor.timezone, sponsor)
+            for nick in sponsor.get("ircnicks") or []:
+                # Strip the `irc:/` or `matrix:/` prefix
+                add(nick.split(":/", 1)[-1], sponsor, whole=True)
+
+        # Reuse the groups that are already computed for the other pages
+        for key in ["interests", "languages", "regions", "timezones"]:
+            for title, members in self.data[key].items():
+                for sponsor in members:
+                    add(title, sponsor, whole=True)
+
+        return json.dumps({
+            "sponsors": [[x.username, html.unescape(x.human_name),
+                          x.is_active] for x in sponsors],
+            "tokens": {k: sorted(v) for k, v in tokens.items()},
+        }, sort_keys=True, separators=(",", ":"))
+
+    def build(self, builders):
+        """
+        Build all the output variants in one pass
+        """
+        with stats.stage("build.pages"):
+            for name in self.templates:
+                for builder in builders:
+                    builder.build_page(name)
+
+        with stats.stage("build.api"):
+            for builder in builders:
+                builder.build_api()
+                builder.build_static()
+
+        with stats.stage("build.compress"):
+            for builder in builders:
+                builder.compress()
+
+        for builder in builders:
+            builder.finish()
+
+
+class Manifest:
+    """
+    Content hash of every file a builder wrote, so that the next build can
+    skip writing files that didn't change and remove files that are not
+    generated anymore
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.previous = {}
+        self.current = {}
+        try:
+            with open(self.path, "r") as f:
+                self.previous = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    @staticmethod
+    def digest(content):
+        if isinstance(content, str):
+            content = BUILD_STAMP.sub("", content).encode("utf-8")
+        return hashlib.sha1(content).hexdigest()
+
+    def add(self, name, content):
+        """
+        Remember the file and return `True` if it changed since the previous
+        build
+        """
+        digest = self.digest(content)
+        self.current[name] = digest
+        return self.previous.get(name) != digest
+
+    def derive(self, name, source):
+        """
+        Remember a file generated from another one, e.g. its compressed
+        variant. It changes exactly when its source changes.
+        """
+        self.current[name] = self.current[source]
+
+    @property
+    def stale(self):
+        return sorted(set(self.previous) - set(self.current))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.current, f, indent=2, sort_keys=True)
+
+
+class Builder:
+    def __init__(self, data, engine=None):
+        self.data = data
+        self.engine = engine or RenderEngine(data)
+        self.manifest = Manifest(self.manifest_path)
+        self.changed = []
+        self.sizes = {}
+
+    @property
+    def builddir(self):
+        here = os.path.dirname(os.path.realpath(__file__))
+        return os.path.join(here, "_build")
+
+    @property
+    def manifest_path(self):
+        """
+        Keep the manifest outside of the output directory, we don't want to
+        deploy it
+        """
+        here = os.path.dirname(os.path.realpath(__file__))
+        name = os.path.basename(self.builddir)
+        return os.path.join(here, "_build", "manifest-{0}.json".format(name))
+
+    def dump_html(self, name, content):
+        raise NotImplemented
+
+    @property
+    def templates(self):
+        return self.engine.templates
+
+    @property
+    def api(self):
+        return self.engine.api
+
+    @property
+    def options(self):
+        return {}
+
+    def build(self):
+        self.engine.build([self])
+
+    def build_page(self, name):
+        builddir = self.builddir_rel_path(name)
+        rendered = self.render_template(
+            name,
+            options=self.options,
+            builddir_rel_path=builddir,
+            cards=self.engine.cards,
+            **self.data
+        )
+        self.dump_html(name, rendered)
+
+    def build_api(self):
+        dstdir = os.path.join(self.builddir, "api")
+        if not os.path.exists(dstdir):
+            os.makedirs(dstdir)
+        for name in self.api:
+            src = os.path.join("_build", name)
+            dst = os.path.join(dstdir, name)
+            self.copy(src, dst)
+        self._build_sponsors_json(dstdir)
+
+    def build_static(self):
+        pass
+
+    def _build_sponsors_json(self, dstdir):
         path = os.path.join(dstdir, "sponsors.json")
-        with open(path, "w") as fp:
-            json.dump(result, fp)
+        self.write(path, self.engine.sponsors_json)
+
+        path = os.path.join(dstdir, "sponsors.ndjson")
+        self.write(path, self.engine.sponsors_ndjson)
+
+        for username, document in self.engine.sponsor_documents.items():
+            path = os.path.join(dstdir, "sponsors", username + ".json")
+            self.write(path, document)
+
+        for name, index in self.engine.sponsor_indexes.items():
+            self.write(os.path.join(dstdir, "index", name), index)
+
+        path = os.path.join(dstdir, "search.json")
+        self.write(path, self.engine.search_index)
 
     def render_template(self, name, **kwargs):
-        jinja_env = Environment(loader=FileSystemLoader("templates"))
-        template = jinja_env.get_template(name)
-        rendered = template.render(**kwargs)
-        return rendered
+        return self.engine.render_template(name, **kwargs)
 
     def write(self, path, content):
+        """
+        Write `content` (either `str` or `bytes`) into `path` unless the file
+        already has the same content
+        """
+        name = os.path.relpath(path, self.builddir)
+        original = len(content.encode("utf-8") if isinstance(content, str)
+                       else content)
+        content = self.postprocess(name, content)
+        self.sizes[name] = original
+        changed = self.manifest.add(name, content)
+        if changed:
+            self.changed.append(name)
+        elif os.path.exists(path):
+            return
+
         dstdir = os.path.dirname(path)
         if not os.path.exists(dstdir):
             os.makedirs(dstdir)
 
-        with open(path, "w") as child:
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with open(path, mode) as child:
             child.write(content)
 
+    def copy(self, src, dst):
+        with open(src, "rb") as f:
+            self.write(dst, f.read())
+
+    def postprocess(self, name, content):
+        """
+        Modify the content of a file before it is written
+        """
+        if name.endswith(".html"):
+            return minify_html(content)
+        return content
+
+    @property
+    def compressors(self):
+        result = [(".gz", lambda data: gzip.compress(data, 9, mtime=0))]
+        if brotli:
+            result.append((".br", lambda data: brotli.compress(data,
+                                                              quality=11)))
+        return result
+
+    def compress(self):
+        """
+        Write precompressed variants of all HTML and API files, so that they
+        can be served without compressing them on the fly
+        """
+        before, after = 0, 0
+        changed = set(self.changed)
+        names = [x for x in self.manifest.current
+                 if x.endswith(COMPRESSED_EXTENSIONS)]
+        for name in sorted(names):
+            path = os.path.join(self.builddir, name)
+            size = os.path.getsize(path)
+            if size < MIN_COMPRESS_SIZE:
+                continue
+
+            sizes = []
+            for extension, function in self.compressors:
+                dst = path + extension
+                self.manifest.derive(name + extension, name)
+                if name in changed or not os.path.exists(dst):
+                    with open(path, "rb") as f:
+                        data = function(f.read())
+                    with open(dst, "wb") as f:
+                        f.write(data)
+                sizes.append("{0} {1}".format(
+                    extension[1:], format_size(os.path.getsize(dst))))
+
+            original = self.sizes.get(name, size)
+            before += original
+            after += size
+            print("  {0}: {1} -> {2}, {3}".format(
+                name, format_size(original), format_size(size),
+                ", ".join(sizes)))
+
+        print("{0}: minified {1} -> {2}{3}".format(
+            type(self).__name__, format_size(before), format_size(after),
+            "" if brotli else " (brotli is not installed, no .br files)"))
+
+    def finish(self):
+        """
+        Remove outputs that are not generated anymore, save the manifest, and
+        report what changed
+        """
+        for name in self.manifest.stale:
+            path = os.path.join(self.builddir, name)
+            if os.path.exists(path):
+                os.remove(path)
+            dstdir = os.path.dirname(path)
+            if os.path.isdir(dstdir) and not os.listdir(dstdir):
+                os.rmdir(dstdir)
+        self.manifest.save()
+
+        print("{0}: {1} changed, {2} removed, {3} unchanged".format(
+            type(self).__name__, len(self.changed), len(self.manifest.stale),
+            len(self.sizes) - len(self.changed)))
+        for name in self.changed:
+            print("  changed: {0}".format(name))
+        for name in self.manifest.stale:
+            print("  removed: {0}".format(name))
+
     def builddir_rel_path(self, template_name):
         """
         Path to the builddir but relative from the rendered template
@@ -370,13 +891,10 @@ class DirHtmlBuilder(Builder):
         dst = os.path.join(dstdir, "index.html")
         self.write(dst, content)
 
-    def build(self):
-        super().build()
-        here = os.path.dirname(os.path.realpath(__file__))
-        filenames = ["style.css", "fedora-logo.png"]
+    def build_static(self):
+        filenames = ["style.css", "fedora-logo.png", "search.js"]
         for filename in filenames:
-            shutil.copy2(os.path.join(filename),
-                        os.path.join(self.builddir, filename))
+            self.copy(filename, os.path.join(self.builddir, filename))
 
     def builddir_rel_path(self, template_name):
         """
@@ -409,36 +927,73 @@ class ProductionBuilder(DirHtmlBuilder):
         return "./"
 
 
-def main():
-    try:
-        # sponsors = get_sponsors_mock()
-        sponsors = get_sponsors()
-    except ConnectionError:
-        print("Unable to get sponsors, try again.")
-        sys.exit(1)
+def minify_html(content):
+    """
+    Collapse all whitespace in a HTML document, browsers collapse it anyway.
+    Only whitespace in the elements where it matters is kept as it is.
+    """
+    def collapse(text):
+        return WHITESPACE.sub(
+            lambda m: "\n" if "\n" in m.group(0) else " ", text)
+
+    result = []
+    position = 0
+    for match in PRESERVED_HTML.finditer(content):
+        result.append(collapse(content[position:match.start()]))
+        result.append(match.group(0))
+        position = match.end()
+    result.append(collapse(content[position:]))
+    return "".join(result)
+
 
-    set_sponsors_activity(sponsors)
+def format_size(size):
+    return "{0:.1f} KiB".format(size / 1024)
 
-    # Sort sponsors alphabetically by their username so that they are always in
-    # a predictable order
-    sponsors.sort(key=lambda x: x.username)
+
+def build_site(sponsors, active_usernames=None, interests=None,
+               languages=None):
+    """
+    Build the site from a list of `Sponsor` objects. Activity and groups are
+    loaded from the `_build` directory unless they are passed.
+    """
+    registry = SponsorRegistry(sponsors, active_usernames)
+    sponsors = registry.sponsors
+    with stats.stage("build.bugzilla"):
+        resolve_bugzilla_user_ids(sponsors)
 
     data = {
         "sponsors": sponsors,
-        "active": active_sponsors(sponsors),
-        "interests": sponsors_by_areas_of_interest(sponsors),
+        "active": active_sponsors(registry),
+        "interests": sponsors_by_areas_of_interest(registry, interests),
         "regions": sponsors_by_region(sponsors),
         "timezones": sponsors_by_timezone(sponsors),
-        "languages": sponsors_by_native_language(sponsors),
+        "languages": sponsors_by_native_language(registry, languages),
         "build_tag": build_tag(),
         "build_timestamp": datetime.now(),
     }
 
-    for builder_class in [HtmlBuilder, DirHtmlBuilder, ProductionBuilder]:
-        print("Building through {0}".format(builder_class.__name__))
-        builder = builder_class(data)
-        builder.build()
-        time.sleep(1)
+    engine = RenderEngine(data)
+    builders = [builder_class(data, engine) for builder_class
+                in [HtmlBuilder, DirHtmlBuilder, ProductionBuilder]]
+    print("Building through {0}".format(
+        ", ".join(type(builder).__name__ for builder in builders)))
+    engine.build(builders)
+
+
+def main():
+    transport.install_from_environment()
+    metrics.install()
+    with stats.stage("build"):
+        try:
+            # sponsors = get_sponsors_mock()
+            with stats.stage("build.fas"):
+                sponsors = get_sponsors()
+        except (ConnectionError, resilience.Unavailable) as ex:
+            print("Unable to get sponsors, try again. {0}".format(ex))
+            sys.exit(1)
+
+        build_site(sponsors)
+    stats.dump("build")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,151 @@
+"""
+Generate synthetic sponsors, groups, and Bugzilla histories
+
+Real data requires live Fedora services and there are only a couple hundred
+sponsors. This allows to benchmark the pipeline with any number of them.
+Everything is generated from a seeded random generator, so the same
+parameters always produce the same data.
+"""
+
+import random
+import string
+import xmlrpc.client
+from datetime import datetime, timedelta
+
+
+TIMEZONES = [
+    "UTC",
+    "Europe/Prague",
+    "Europe/Berlin",
+    "Europe/London",
+    "America/New_York",
+    "America/Los_Angeles",
+    "America/Sao_Paulo",
+    "America/St_Johns",
+    "Asia/Kolkata",
+    "Asia/Tokyo",
+    "Asia/Shanghai",
+    "Australia/Adelaide",
+    "Africa/Lagos",
+    "Pacific/Auckland",
+    # Invalid timezones happen too
+    "Mars/Olympus_Mons",
+]
+
+# 177841 is FE-NEEDSPONSOR
+FE_NEEDSPONSOR = 177841
+
+
+def random_word(rng, length=8):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def generate_users(count, seed=0):
+    """
+    FAS users in the same format as fasjson returns them
+    """
+    rng = random.Random(seed)
+    users = []
+    for i in range(count):
+        username = "{0}{1}".format(random_word(rng, 6), i)
+        users.append({
+            "username": username,
+            "human_name": "{0} {1}".format(random_word(rng).capitalize(),
+                                           random_word(rng).capitalize()),
+            "emails": ["{0}@example.com".format(username)],
+            "rhbzemail": None,
+            "timezone": rng.choice(TIMEZONES),
+            "ircnicks": ["irc:/{0}".format(username)] if rng.random() < 0.5
+            else None,
+            "github_username": username if rng.random() < 0.5 else None,
+            "gitlab_username": None,
+            "website": None,
+            "locked": False,
+            "is_private": False,
+        })
+    return users
+
+
+def generate_groups(usernames, count, members=10, seed=0):
+    """
+    Groups in the same format as `interests.yaml` or `languages.yaml`
+    """
+    rng = random.Random(seed)
+    groups = []
+    for i in range(count):
+        users = rng.sample(usernames, min(members, len(usernames)))
+        groups.append({"id": "{0}{1}".format(random_word(rng), i),
+                       "users": users})
+    return groups
+
+
+def generate_active_usernames(usernames, ratio=0.5, seed=0):
+    rng = random.Random(seed)
+    return {x for x in usernames if rng.random() < ratio}
+
+
+class SyntheticBug:
+    """
+    Has the same attributes as `bugzilla.Bug` that `activity.py` needs
+    """
+
+    def __init__(self, id, assigned_to, blocks, last_change_time):
+        self.id = id
+        self.assigned_to = assigned_to
+        self.blocks = blocks
+        self.last_change_time = last_change_time
+
+
+class StaticHistories:
+    """
+    Behaves like `activity.BugHistories` but everything is already in memory,
+    indexed by bug IDs
+    """
+
+    def __init__(self, histories):
+        self.histories = histories
+
+    def prefetch(self, bugs):
+        pass
+
+    def get(self, bug):
+        return self.histories[bug.id]
+
+
+def generate_bug(bug_id, assignee, depth, active=False, seed=0):
+    """
+    Return a bug and its history in the same format as
+    `Bug.get_history_raw` returns it. The history has `depth` changes, none
+    of them by the assignee, unless the bug is `active`.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    blocks = [FE_NEEDSPONSOR] if rng.random() < 0.5 else []
+
+    history = []
+    for i in range(depth):
+        when = now - timedelta(days=(depth - i) * 3)
+        history.append({
+            "when": xmlrpc.client.DateTime(when),
+            "who": "{0}@example.com".format(random_word(rng)),
+            "changes": [{
+                "field_name": "status",
+                "removed": "NEW",
+                "added": "ASSIGNED",
+            }],
+        })
+
+    if active and history:
+        # The activity happened somewhere in the middle
+        change = history[depth // 2]
+        change["who"] = assignee
+        change["changes"].append({
+            "field_name": "flagtypes.name",
+            "removed": "",
+            "added": "fedora-review+",
+        })
+
+    last_change_time = history[-1]["when"] if history \
+        else xmlrpc.client.DateTime(now)
+    bug = SyntheticBug(bug_id, assignee, blocks, last_change_time)
+    return bug, {"bugs": [{"id": bug_id, "history": history}]}
@@ -0,0 +1,150 @@
+"""
+Tests for the incremental activity detection in activity.py
+
+No network access is needed, FAS users, configs, and Bugzilla bugs are all
+prepared in memory.
+"""
+
+import json
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import activity
+import groups
+import synthetic
+
+
+class StaticIndex(activity.ReviewBugsIndex):
+    """
+    Behaves like `activity.ReviewBugsIndex` but all bugs are already known
+    """
+
+    def __init__(self, bugs, since=None):
+        self.since = since
+        self.by_assignee = {}
+        for bug in bugs:
+            self.by_assignee.setdefault(bug.assigned_to, []).append(bug)
+
+
+def email(username):
+    return "{0}@example.com".format(username)
+
+
+def make_users(*usernames):
+    for username in usernames:
+        groups.FAS_USERS[username] = {
+            "username": username,
+            "human_name": username.capitalize(),
+            "emails": [email(username)],
+            "rhbzemail": None,
+            "locked": False,
+            "is_private": False,
+        }
+    return {x: activity.User(x, None, None) for x in usernames}
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch, tmp_path):
+    path = str(tmp_path / "activity-state.json")
+    monkeypatch.setattr(activity, "state_path", lambda: path)
+    monkeypatch.setattr(activity, "DIRECTLY_SPONSORED", {})
+    monkeypatch.setattr(groups, "FAS_USERS", {})
+    monkeypatch.setattr(groups, "PERSONAL_CONFIGS", {})
+    monkeypatch.setattr(activity.cache, "enabled", False)
+
+
+def test_index_since_only_bugzilla_candidates():
+    now = datetime.now()
+    state = {"a": {"evaluated": now.isoformat()}}
+    users = make_users("a", "yaml_sponsor", "direct")
+    configs = {"a": None, "yaml_sponsor": {"interests": []}, "direct": None}
+    activity.DIRECTLY_SPONSORED["direct"] = [("newbie", date.today())]
+
+    candidates = activity.bugzilla_candidates(users, state, configs)
+    assert candidates == ["a"]
+    assert activity.index_since(state, candidates) == \
+        now.date() - timedelta(days=1)
+
+    # Sponsors that never queried Bugzilla need the whole window
+    state = {}
+    candidates = activity.bugzilla_candidates(users, state, configs)
+    assert candidates == ["a"]
+    assert activity.index_since(state, candidates) is None
+
+
+def test_bugzilla_candidates_unknown_configs():
+    state = {"a": {"evaluated": datetime.now().isoformat()}}
+    users = make_users("a", "new")
+    assert activity.bugzilla_candidates(users, state) == ["a"]
+
+    # Without any state, everybody needs the whole window
+    candidates = activity.bugzilla_candidates(users, {})
+    assert candidates == ["a", "new"]
+    assert activity.index_since({}, candidates) is None
+
+
+def test_state_round_trip():
+    usernames = ["a", "b", "yaml_sponsor"]
+    users = make_users(*usernames)
+    configs = {"a": None, "b": None, "yaml_sponsor": {"interests": []}}
+    groups.PERSONAL_CONFIGS.update(configs)
+
+    bug_a, history_a = synthetic.generate_bug(1, email("a"), 10, seed=1)
+    bug_b, history_b = synthetic.generate_bug(2, email("b"), 10, active=True,
+                                              seed=2)
+    histories = synthetic.StaticHistories({1: history_a, 2: history_b})
+
+    # The first run has no previous state and examines the whole window
+    state = {}
+    index = StaticIndex([bug_a, bug_b])
+    results = activity.process_users(
+        usernames, None, None, state=state, index=index, histories=histories,
+        users=users, configs=configs)
+    assert not results["a"]
+    assert results["b"].username == "b"
+    assert results["yaml_sponsor"].username == "yaml_sponsor"
+
+    # Sponsors that didn't look into Bugzilla have no state
+    assert set(state) == {"a", "b"}
+    assert state["a"]["last_activity"] is None
+    assert state["a"]["examined"] == [1]
+    assert state["b"]["rule"] == "fedora-review+"
+    assert state["b"]["bug"] == 2
+
+    with open(activity.state_path(), "w") as f:
+        json.dump(state, f)
+    state = activity.load_state()
+
+    # The next run needs only changes since the first one, and only for the
+    # sponsors without any recent activity
+    candidates = activity.bugzilla_candidates(users, state, configs)
+    assert candidates == ["a"]
+    since = activity.index_since(state, candidates)
+    assert since == date.today() - timedelta(days=1)
+
+    index = StaticIndex([bug_a, bug_b], since=since)
+    assert index.covers(since)
+    assert not index.covers(None)
+    results = activity.process_users(
+        usernames, None, None, state=state, index=index, histories=histories,
+        users=users, configs=configs)
+    assert not results["a"]
+    assert results["b"].username == "b"
+    assert state["b"]["rule"] == "fedora-review+"
+
+
+def test_unknown_sponsors_stay_active():
+    today = date.today()
+    state = {
+        "recent": {"last_activity": (today - timedelta(days=10)).isoformat()},
+        "expired": {"last_activity": (today - timedelta(
+            days=activity.DAYS_AGO + 1)).isoformat()},
+    }
+    assert activity.previously_active("recent", state, set())
+    assert not activity.previously_active("expired", state, set())
+    assert not activity.previously_active("yaml_sponsor", state, set())
+
+    # Sponsors without any state, e.g. with a sponsor.yaml, keep their status
+    # from the previous list of active sponsors
+    assert activity.previously_active("yaml_sponsor", state, {"yaml_sponsor"})
@@ -0,0 +1,160 @@
+"""
+Record and replay all HTTP traffic to FAS, Bugzilla, and fedorapeople.org
+
+The fasjson client, python-bugzilla, and our own fedorapeople.org fetcher
+all use `requests` under the hood, so it is enough to hook into
+`requests.Session.send`. Set these environment variables to enable it:
+
+- `FEDORA_SPONSORS_TRANSPORT` - `record` or `replay`
+- `FEDORA_SPONSORS_FIXTURES` - directory with the fixture store
+  (default `fixtures/`)
+- `FEDORA_SPONSORS_LATENCY` - seconds of latency to add to each replayed
+  response
+- `FEDORA_SPONSORS_ERROR_RATE` - ratio (0 to 1) of replayed requests that
+  fail with a connection error
+
+Only responses are stored, request headers (and therefore credentials)
+are never written to the disk.
+"""
+
+import os
+import re
+import time
+import json
+import base64
+import random
+import hashlib
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# Bump this when the format of stored responses changes, old fixtures will
+# then simply not be found
+FORMAT_VERSION = 2
+
+# Response headers that are useless or even harmful to replay
+SKIPPED_HEADERS = {"content-encoding", "transfer-encoding", "set-cookie"}
+
+# Parts of requests that depend on the current date, e.g. the time range of
+# incremental Bugzilla queries or datagrepper searches. They are left out of
+# the fixture keys, so that a recording can be replayed on any other day.
+VOLATILE = [
+    re.compile(rb"\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}(\.\d+)?)?"),
+    re.compile(rb"(?<=[?&]start=)\d+"),
+]
+
+_original_send = requests.Session.send
+
+
+class ReplayMiss(RuntimeError):
+    """
+    There is no recorded response for a request. This is intentionally not
+    a `requests.RequestException`, so it isn't retried.
+    """
+
+
+class FixtureStore:
+    """
+    One JSON file per response, named after a hash of its request
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, "v{0}".format(FORMAT_VERSION))
+
+    def key(self, request):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        url = request.url.encode("utf-8")
+        for pattern in VOLATILE:
+            url = pattern.sub(b"", url)
+            body = pattern.sub(b"", body)
+
+        digest = hashlib.sha1()
+        digest.update(request.method.encode("utf-8"))
+        digest.update(url)
+        digest.update(body)
+        return digest.hexdigest()
+
+    def save(self, request, response):
+        os.makedirs(self.path, exist_ok=True)
+        data = {
+            "method": request.method,
+            "url": request.url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {k: v for k, v in response.headers.items()
+                        if k.lower() not in SKIPPED_HEADERS},
+            "body": base64.b64encode(response.content).decode("ascii"),
+        }
+        path = os.path.join(self.path, self.key(request) + ".json")
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+    def load(self, request):
+        path = os.path.join(self.path, self.key(request) + ".json")
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            raise ReplayMiss("No recorded response for {0} {1}"
+                             .format(request.method, request.url))
+
+        response = requests.Response()
+        response.status_code = data["status"]
+        response.reason = data["reason"]
+        response.headers = CaseInsensitiveDict(data["headers"])
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response.url = request.url
+        response.request = request
+        response._content = base64.b64decode(data["body"])
+        response._content_consumed = True
+        return response
+
+
+def install(mode, path, latency=0, error_rate=0):
+    """
+    Hook into `requests` to either `record` or `replay` all responses
+    """
+    store = FixtureStore(path)
+
+    def record(session, request, **kwargs):
+        response = _original_send(session, request, **kwargs)
+        store.save(request, response)
+        return response
+
+    def replay(session, request, **kwargs):
+        if latency:
+            time.sleep(latency)
+        if error_rate and random.random() < error_rate:
+            raise requests.ConnectionError(
+                "Injected error for {0}".format(request.url))
+        return store.load(request)
+
+    if mode == "record":
+        requests.Session.send = record
+    elif mode == "replay":
+        requests.Session.send = replay
+    else:
+        raise ValueError("Unknown transport mode: {0}".format(mode))
+    print("Transport: {0} {1}".format(mode, store.path))
+
+
+def uninstall():
+    requests.Session.send = _original_send
+
+
+def install_from_environment():
+    """
+    Call this at the beginning of every entry point
+    """
+    mode = os.environ.get("FEDORA_SPONSORS_TRANSPORT")
+    if not mode:
+        return
+    install(
+        mode,
+        os.environ.get("FEDORA_SPONSORS_FIXTURES", "fixtures"),
+        latency=float(os.environ.get("FEDORA_SPONSORS_LATENCY", 0)),
+        error_rate=float(os.environ.get("FEDORA_SPONSORS_ERROR_RATE", 0)),
+    )